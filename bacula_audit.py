@@ -1,31 +1,80 @@
 #!/usr/bin/python3
 '''
-Script to Restore a single random file
+Script to Restore random files from one or more datasets
 Checksums it against an existing file to ensure all is correct
 Sends email if there is a problem
 Assumes there is a ".zfs/<date>-monthly" snapshot
+Optional: "-policy" - how to pick the dataset to audit (defaults to "risk")
+"-simulate" - don't audit anything, compare the selection policies over this many simulated runs
+"-seed" - Random seed for the simulation, so runs can be repeated
+"-count" - how many datasets to audit this run (default 1)
+"-parallel" - how many Restores to run at once (default 2)
+"-budget" - bytes each restore client may hold at once (default 500M)
 '''
+import argparse
 import subprocess
 from datetime import datetime
 import csv
 import hashlib
+import math
 import os
+import platform
 import random
-import re
+import shlex
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import bacula_functions as bf
+from bacula_job_check import size_convert
+
+#Columns in the Audit File. Older files only have the first 3, the rest default when read
+AUDIT_FIELDS = ("path", "server", "checked", "last_checked", "last_snapshot", "failures", "size", "written")
+AUDIT_DEFAULTS = {"checked": "0", "last_checked": "0", "last_snapshot": "", "failures": "0",
+                  "size": "0", "written": ""}
+#Weights for the risk-weighted selection, see risk_score
+RISK_WEIGHTS = {"written": 0.4, "size": 0.2, "age": 0.3, "failures": 0.1}
+#Days without an audit before a dataset gets the full "age" score
+AGE_HORIZON_DAYS = 180
 
 def main():
     '''
     Main section of script, calls various other functions!
     '''
+    parser = argparse.ArgumentParser(description="Bacula Restore Audit Script.")
+    parser.add_argument("-policy", help="How to pick the dataset to audit",
+        choices=list(SELECTION_POLICIES), default="risk")
+    parser.add_argument("-simulate", help="Compare the selection policies over this many runs (offline)",
+        type=int, default=0)
+    parser.add_argument("-seed", help="Random seed for the simulation", type=int, default=0)
+    parser.add_argument("-count", help="Number of datasets to audit this run", type=int, default=1)
+    parser.add_argument("-parallel", help="Number of Restores to run at once", type=int, default=2)
+    parser.add_argument("-budget", help="Bytes each restore client may hold at once (e.g. 500M)",
+        default="500M")
+    args = parser.parse_args()
     #Local Variables:
     email_address = "<NOTIFICATION EMAIL>"
-    local_restore_path = "/tmp/restore/"
+    #Restore clients & the folder Restores land in on each. "localhost" is the Director
+    restore_clients = {"localhost": "/tmp/restore/"}
     log_file = "/var/log/bacula/logs/audit" + "-" + datetime.today().strftime('%Y-%m-%d') + ".log"
     servers = [ '<SERVER1>', '<SERVER2>', '<SERVER3>' ]
     audit_file_path = "/var/log/zfs-audit-list/"
+    bacula_conf_path = "/opt/bacula/etc/conf.d/Director/" + platform.node().split(".")[0] + "-dir/"
+    #Only audit files at most this big, and not modified in this many days (so the backup still matches)
+    max_file_size = 50*1000*1000
+    min_file_age = 35
+    restore_budget = size_convert(args.budget)
     zfs_datasets = []
     auditing_list = []
+    if args.simulate > 0:
+        #Simulation only needs the Audit File, nothing is SSH'd to or restored
+        results = simulate_policies(audit_file_read(audit_file_path), SELECTION_POLICIES,
+                                    args.simulate, args.seed)
+        for policy, result in results.items():
+            print(f"{policy}: {result['detected']} of {result['events']} corruptions detected, "
+                  f"mean {result['mean_days']:.1f} runs to detection, {result['undetected']} undetected")
+        return
     #Main Script:
     write_log(log_file, "Starting Audit Job")
     #TODO: Likely change this to use SSH Key-based login instead
@@ -47,123 +96,369 @@ def main():
             #Loop through the list and add any missing items:
             if not any(d['path'] == zfs_item[0] for d in auditing_list):
                 write_log(log_file, f"Dataset: {zfs_item[0]} not in Audit List, adding it")
-                auditing_list.append({"path" : zfs_item[0], "server" : zfs_item[1], "checked" : "0"})
+                auditing_list.append(AUDIT_DEFAULTS | {"path" : zfs_item[0], "server" : zfs_item[1]})
                 audit_file_write(audit_file_path, auditing_list)
     else:
         write_log(log_file, f"NOTE: Audit file {audit_file_path} does not exist, creating it")
         #Audit List File doesn't exist, so create the file, and do the list
         for item in zfs_datasets:
-            auditing_list.append({"path" : item[0], "server" : item[1], "checked" : "0"})
+            auditing_list.append(AUDIT_DEFAULTS | {"path" : item[0], "server" : item[1]})
         audit_file_write(audit_file_path, auditing_list)
-    auditing_list = sorted(auditing_list, key = lambda no_check: no_check['checked'])
-    if int(auditing_list[0]['checked']) == int(auditing_list[1]['checked']):
-        #smallest 2 jobs' numbers are the same, so we should find all of them and pick a random one
-        subset_list = []
-        subset_list.append(auditing_list[0])
-        for audit_item in auditing_list:
-            if audit_item['checked'] == subset_list[-1]['checked']:
-                subset_list.append(audit_item)
-        dataset = random.choice(subset_list)
-    else:
-        dataset = auditing_list[0]
-    try:
-        monthly_path = get_latest_monthly(dataset, username)
-        write_log(log_file, f"Server: {dataset["server"]} Dataset: {dataset["path"]} Snapshot: {monthly_path} chosen for Audit")
-        audit_file = get_files(server, monthly_path, username)
-        remote_checksum = checksum_file(server, audit_file, username)
-        #print(f"File: {audit_file} / checksum: {remote_checksum}")
-        write_log(log_file, f"File {audit_file} Checksum: {remote_checksum}")
-    except subprocess.CalledProcessError as exc:
-        write_log(log_file, f"Error SSH'ing to {server}")
-        bf.error_email(email_address, f"Error SSH'ing to {server}")
-        raise ConnectionError(f"Error connecting to {server}") from exc
-    except IOError as e:
-        bf.error_email(email_address, f"IOError! \n{e}")
-        raise e
-    file_tuple = os.path.split(audit_file)
-    #RegEx magic to remove the whole ".zfs/snapshot/zback-name" from the string, so Bacula has a proper path for the file
-    backups_file_path = re.sub(r'\/\.zfs\/snapshot\/\zback:\d{4}-\d{2}-\d{2}-\d{4}:monthly', '', audit_file)
-    local_file_path = local_restore_path + file_tuple[1]
-    #Update the Audit List, as a Restore can take a long time
-    #we don't want a second restore of the same dataset due to waiting.
-    updated_audit_list = []
-    for list_item in auditing_list:
-        if list_item['path'] == dataset['path']:
-            updated_audit_list.append({'path': f"{list_item['path']}", 'server': f"{list_item['server']}", 'checked': int(list_item['checked']) +1})
+    #Refresh the size & changed-bytes of every dataset, one SSH per server
+    for server in servers:
+        try:
+            zfs_stats(server, [item for item in auditing_list if item['server'] == server], username)
+        except subprocess.CalledProcessError:
+            #Carry on with the other servers
+            write_log(log_file, f"Error getting ZFS stats from {server}, using previous values")
+    audit_file_write(audit_file_path, auditing_list)
+    #Pick the datasets for this run, and mark them as checked now. Restores can take a long time,
+    #we don't want a second run restoring the same datasets due to waiting.
+    datasets = SELECTION_POLICIES[args.policy](auditing_list, time.time(), random.Random())[:args.count]
+    for dataset in datasets:
+        audit_list_update(auditing_list, dataset['path'], checked=int(dataset['checked']) + 1,
+                          last_checked=int(time.time()))
+    audit_file_write(audit_file_path, auditing_list)
+    budget = RestoreBudget([RestoreWorkspace(client, path, restore_budget, username)
+                            for client, path in restore_clients.items()])
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = [executor.submit(audit_dataset, dataset, bacula_conf_path, budget, username,
+                                   max_file_size, min_file_age) for dataset in datasets]
+        results = [future.result() for future in futures]
+    failed = 0
+    for result in results:
+        dataset = result['dataset']
+        write_log(log_file, f"Server: {dataset["server"]} Dataset: {dataset["path"]} Snapshot: {result['snapshot']}")
+        if result['snapshot'] != "":
+            #"written" is now counted from this snapshot, so reset it
+            audit_list_update(auditing_list, dataset['path'], last_snapshot=os.path.basename(result['snapshot']),
+                              written=0)
+        if result['error'] is not None:
+            write_log(log_file, "!!!ERROR!!!")
+            write_log(log_file, result['error'])
+            bf.error_email(email_address, f"Error auditing {dataset['server']} - {dataset['path']}\n {result['error']}")
         else:
-            updated_audit_list.append(list_item)
-    audit_file_write(audit_file_path, updated_audit_list)
-    try:
-        #Make sure the restore-folder already exists:
-        os.makedirs(local_restore_path, exist_ok=True)
-        restore_client = dataset['server'].split(".")[0] + "-fd"
-        #Call the Restore Function, store the JobID returned:
-        restore_status, restore_jobid = bf.bacula_restore(restore_client, file_tuple[0], backups_file_path, local_restore_path)
-        if restore_status == "Restore OK":
-            write_log(log_file, f"Restored file {local_restore_path}, Job: {restore_jobid}")
+            write_log(log_file, f"File {result['file']} restored by {result['restore_jobid']} "
+                                f"Remote Checksum: {result['remote']} Local Checksum: {result['local']}")
+        if result['local'] is not None and result['local'] != result['remote']:
+            #We've got a problem!
+            write_log(log_file, "ERROR! Checksums do not match!")
+            bf.send_email(email_address, "Checksum failed", f"Failed check for: {dataset}")
+        if result['error'] is not None or result['local'] != result['remote']:
+            failed += 1
         else:
-            #What do we do when it didn't restore OK?
-            raise RuntimeError (f"Restore Error! Job: {restore_jobid} \n Status: {restore_status}")
-    except (subprocess.CalledProcessError, bf.BConsoleError, RuntimeError) as e:
-        #BConsoleError is one we manually raise, handle it the same though!
-        write_log(log_file, "!!!ERROR!!!")
-        write_log(log_file, "Bacula Restore failed")
-        write_log(log_file, e)
-        bf.error_email(email_address, f"Error with Bacula Restore for {dataset['server']} - {dataset['path']}\n {e}")
-        raise e # we need to quit out here...
+            write_log(log_file, "Checksums match!")
+        #Only a bad restore or checksum says anything about the backup, not being able to pick a file
+        #(no Job, SSH errors etc.) shouldn't raise the dataset's risk every run
+        if result['restore_failed'] or (result['local'] is not None and result['local'] != result['remote']):
+            audit_list_update(auditing_list, dataset['path'], failures=int(dataset['failures']) + 1)
+    audit_file_write(audit_file_path, auditing_list)
+    write_log(log_file, f"Audit completed, {len(results) - failed} of {len(results)} datasets passed")
+
+class RestoreWorkspace():
+    '''
+    A folder on a restore client that Restores land in, with a byte budget
+    "client" is a Bacula client (without "-fd"), or "localhost" for the Director
+    '''
+    def __init__(self, client:str, path:str, budget_b:int, username:str):
+        self.client = client
+        self.path = path if path.endswith("/") else path + "/"
+        self.budget_b = budget_b
+        self.username = username
+        self.in_use_b = 0
+
+    def has_space(self, size_b:int) -> bool:
+        '''
+        Checks the budget, and for "localhost" that the disk really has the space
+        '''
+        if self.in_use_b + size_b > self.budget_b:
+            return False
+        if self.client == "localhost":
+            os.makedirs(self.path, exist_ok=True)
+            #Restores already admitted may not have written anything yet, so keep their space free too
+            return shutil.disk_usage(self.path).free - self.in_use_b > size_b
+        return True
+
+    def checksum(self, file:str) -> str:
+        '''
+        SHA1 of a restored file, hashed where it landed
+        '''
+        if self.client == "localhost":
+            return checksum_file("local", file, "none")
+        return checksum_file(self.client, file, self.username)
+
+    def remove(self, folder:str):
+        '''
+        Deletes a Restore's folder and everything in it
+        '''
+        if self.client == "localhost":
+            shutil.rmtree(folder, ignore_errors=True)
+        else:
+            subprocess.run(['ssh', f'{self.username}@{self.client}', f"rm -rf {shlex.quote(folder)}"],
+                           capture_output=True, text=True, check=True)
+
+class RestoreBudget():
+    '''
+    Admits Restores to RestoreWorkspaces, so the bytes being restored never go over any workspace's budget
+    Restores wait until there is space, and go to the workspace with the most budget left
+    '''
+    def __init__(self, workspaces:list[RestoreWorkspace]):
+        self.workspaces = workspaces
+        self.condition = threading.Condition()
+
+    def admit(self, size_b:int) -> RestoreWorkspace:
+        '''
+        Waits until a workspace has "size_b" bytes free, reserves them and returns the workspace
+        Raises ValueError if the file is bigger than every budget, or IOError if nothing is
+        running and no disk has the space (so waiting wouldn't help)
+        '''
+        if size_b > max(workspace.budget_b for workspace in self.workspaces):
+            raise ValueError(f"Restore of {size_b} bytes is bigger than any restore budget")
+        with self.condition:
+            while True:
+                free = [workspace for workspace in self.workspaces if workspace.has_space(size_b)]
+                if free:
+                    workspace = max(free, key=lambda item: item.budget_b - item.in_use_b)
+                    workspace.in_use_b += size_b
+                    return workspace
+                if all(workspace.in_use_b == 0 for workspace in self.workspaces):
+                    raise IOError(f"No restore client has {size_b} bytes of disk free")
+                self.condition.wait()
+
+    def release(self, workspace:RestoreWorkspace, size_b:int):
+        '''
+        Gives back bytes reserved by admit, and wakes up anything waiting for space
+        '''
+        with self.condition:
+            workspace.in_use_b -= size_b
+            self.condition.notify_all()
+
+def audit_dataset(dataset:dict, conf_path:str, budget:RestoreBudget, username:str,
+                  max_file_size:int, min_file_age:int) -> dict:
+    '''
+    Audits one dataset: picks a file from the Catalog, checksums it in the snapshot, restores it
+    into a workspace from "budget", checksums the restored file as soon as it lands and deletes it
+    Safe to run several at once. Errors are returned rather than raised, so one bad dataset doesn't
+    stop the others
+    Returns a Dictionary of "dataset", "snapshot", "file", "restore_jobid", "remote", "local", "error",
+    "restore_failed" (True if a file was picked but Bacula couldn't restore it)
+    '''
+    result = {"dataset": dataset, "snapshot": "", "file": "", "restore_jobid": "",
+              "remote": None, "local": None, "error": None, "restore_failed": False}
+    server = dataset['server']
     try:
-        local_checksum = checksum_file("local", local_file_path, "none")
-    except FileNotFoundError as e:
-        print(f"File {local_file_path} not found")
-        write_log(log_file, f"Local restore file: {local_file_path} not found!")
-        bf.error_email(email_address, f"Can't find file {local_file_path} after restore!\n{e}")
-        raise (f"File {local_file_path} not found") from e
-    write_log(log_file, f"Restored file checksum: {local_checksum}")
-    #Compare the checksums:
-    if local_checksum != remote_checksum:
-        #We've got a problem!
-        write_log(log_file, "ERROR! Checksums do not match!")
-        write_log(log_file, f"Remote Checksum: {remote_checksum} <> Local Checksum: {local_checksum}")
-        bf.send_email(email_address, "Checksum failed", f"Failed check for: {dataset}")
-    else:
-        #They do match!
-        write_log(log_file, "Checksums match!")
-    #Cleanup file:
+        #Snapshot first, so "written" is still reset if the dataset has no Job to audit
+        result['snapshot'] = get_latest_monthly(dataset, username)
+        #Find the dataset's last good Full, we only want to pick files that were actually backed up
+        audit_job_id, fileset = get_audit_job(conf_path, dataset)
+        backups_file_path, result['file'], size_b = get_catalog_file(dataset, result['snapshot'], audit_job_id,
+                                                                     username, max_file_size, min_file_age)
+        result['remote'] = checksum_file(server, result['file'], username)
+        workspace = budget.admit(size_b)
+    except subprocess.CalledProcessError as e:
+        result['error'] = f"Error SSH'ing to {server}: {e}"
+        return result
+    except (bf.BConsoleError, LookupError, ValueError, IOError) as e:
+        result['error'] = f"Error finding a file to audit: {e}"
+        return result
+    file_tuple = os.path.split(backups_file_path)
+    #Each Restore gets its own folder, so files with the same name don't collide
+    restore_folder = workspace.path + uuid.uuid4().hex + "/"
     try:
-        os.remove(local_file_path)
-    except OSError:
-        write_log(log_file, f"ERROR! Can't remove {local_file_path}")
-        bf.error_email(email_address, f"Error deleting {local_file_path}")
-    #If we get here, everything worked!
-    write_log(log_file, "Audit completed successfully")
+        restore_status, result['restore_jobid'] = bf.bacula_restore(
+            server.split(".")[0], backups_file_path, file_tuple[0], restore_folder, workspace.client, fileset)
+        #Warnings (JobStatus W) still restored the file, the checksum decides if it's good
+        if restore_status not in ("Restore OK", "Restore OK -- with warnings"):
+            result['restore_failed'] = True
+            raise RuntimeError(f"Restore Error! Job: {result['restore_jobid']} \n Status: {restore_status}")
+        result['local'] = workspace.checksum(restore_folder + file_tuple[1])
+    except (subprocess.CalledProcessError, bf.BConsoleError, RuntimeError, IOError) as e:
+        result['error'] = f"Bacula Restore failed: {e}"
+    finally:
+        try:
+            workspace.remove(restore_folder)
+        except subprocess.CalledProcessError as e:
+            #Keep any restore error, it's the one that matters
+            cleanup_error = f"Error deleting {restore_folder} on {workspace.client}: {e}"
+            if result['error'] is None:
+                result['error'] = cleanup_error
+            else:
+                result['error'] = result['error'] + "\n" + cleanup_error
+        budget.release(workspace, size_b)
+    return result
 
 def audit_file_write(audit_file_path:str, audit_list:list):
     '''
     Function to write Audit File as CSV in format
-    mountpoint, server, checked
+    mountpoint, server, checked, last_checked, last_snapshot, failures, size, written
     '''
     with open(audit_file_path, 'w', encoding='utf-8') as csv_file:
         writer = csv.writer(csv_file, dialect="excel")
         for row in audit_list:
-            writer.writerow([row[0], row[1], row[2]])
+            writer.writerow([row[field] for field in AUDIT_FIELDS])
 
 def audit_file_read(audit_file_path) -> list:
     '''
     Function to read the Audit File (CSV)
     Returns a list of Dictionary items, sorted by the "checked" field
+    Columns missing from older Audit Files are filled in from AUDIT_DEFAULTS
     '''
     audit_list = []
     if os.path.exists(audit_file_path):
         try:
             with open(audit_file_path, 'r', encoding='utf-8') as csv_file:
-                reader = csv.DictReader(csv_file, fieldnames=("path", "server", "checked"), dialect='excel')
+                reader = csv.DictReader(csv_file, fieldnames=AUDIT_FIELDS, dialect='excel')
                 for row in reader:
+                    for field, default in AUDIT_DEFAULTS.items():
+                        if row[field] is None:
+                            row[field] = default
                     audit_list.append(row)
         except IOError as exc:
             raise(f"Error reading Audit file {audit_file_path}") from exc
     else:
         raise FileNotFoundError
-    return sorted(audit_list, key = lambda no_check: no_check['checked'])
+    return sorted(audit_list, key = lambda no_check: int(no_check['checked']))
+
+def audit_list_update(audit_list:list, path:str, **changes):
+    '''
+    Updates the fields passed in "changes" for the item in the Audit List with the given path
+    Values are stored as strings, as they would be if read from the Audit File
+    '''
+    for list_item in audit_list:
+        if list_item['path'] == path:
+            for field, value in changes.items():
+                list_item[field] = str(value)
+
+def rank_least_checked(audit_list:list, now:float, rng:random.Random) -> list:
+    '''
+    Selection policy: lowest "checked" count first, ties broken randomly
+    (The original way datasets were picked)
+    Returns the Audit List ordered by priority
+    '''
+    shuffled = audit_list.copy()
+    rng.shuffle(shuffled)
+    return sorted(shuffled, key = lambda no_check: int(no_check['checked']))
+
+def risk_score(item:dict, now:float, max_size:int, max_written:int, weights:dict=None) -> float:
+    '''
+    Scores a dataset by how likely an audit of it is to find corruption, between 0 and 1
+    Made up of bytes written since the last audited snapshot, size, time since the last audit
+    and past failures, each scaled to 0-1 and weighted by "weights" (defaults to RISK_WEIGHTS)
+    Bytes are log-scaled, so a few huge datasets don't drown out everything else
+    '''
+    if weights is None:
+        weights = RISK_WEIGHTS
+    size = int(item['size'])
+    size_term = math.log1p(size) / math.log1p(max_size) if max_size > 0 else 0.0
+    if item['written'] == "":
+        #Never audited, or ZFS couldn't tell us - assume everything has changed
+        written_term = 1.0
+    else:
+        written = int(item['written'])
+        written_term = math.log1p(written) / math.log1p(max_written) if max_written > 0 else 0.0
+    last_checked = int(item['last_checked'])
+    if last_checked == 0:
+        age_term = 1.0
+    else:
+        age_term = min((now - last_checked) / 86400 / AGE_HORIZON_DAYS, 1.0)
+    failure_term = min(int(item['failures']), 3) / 3
+    return (weights["written"] * written_term + weights["size"] * size_term
+            + weights["age"] * age_term + weights["failures"] * failure_term)
+
+def rank_risk_weighted(audit_list:list, now:float, rng:random.Random) -> list:
+    '''
+    Selection policy: highest risk_score first, ties broken randomly
+    Returns the Audit List ordered by priority
+    '''
+    max_size = max((int(item['size']) for item in audit_list), default=0)
+    max_written = max((int(item['written']) for item in audit_list if item['written'] != ""), default=0)
+    shuffled = audit_list.copy()
+    rng.shuffle(shuffled)
+    return sorted(shuffled, key = lambda item: risk_score(item, now, max_size, max_written),
+                  reverse=True)
+
+#Selection policies, name : function(audit_list, now, rng) returning the Audit List by priority
+SELECTION_POLICIES = {
+    "least-checked": rank_least_checked,
+    "risk": rank_risk_weighted
+}
+
+def simulate_policies(audit_list:list, policies:dict, runs:int, seed:int=0,
+                      run_days:float=1.0, events_per_run:float=0.05, now:float | None=None) -> dict:
+    '''
+    Deterministic offline comparison of selection policies, using only the Audit File
+    Corruption "events" land on datasets with a chance weighted by how much they change
+    (bytes written per day since their last audit) and their size. The same events, from "seed",
+    are used for every policy. Each run one dataset is audited, finding any corruption on it.
+    The simulation starts at "now", by default the latest "last_checked" in the Audit File,
+    so the same Audit File & seed always give the same results
+    Returns a Dictionary of policy name : {"events", "detected", "undetected", "mean_days"}
+    '''
+    if now is None:
+        now = max((int(item['last_checked']) for item in audit_list), default=0)
+    start = now
+    #Estimate bytes written per day for each dataset from the Audit File
+    rates = []
+    for item in audit_list:
+        last_checked = int(item['last_checked'])
+        if item['written'] != "" and last_checked > 0 and start > last_checked:
+            rates.append(int(item['written']) / ((start - last_checked) / 86400))
+        else:
+            rates.append(0.0)
+    sizes = [int(item['size']) for item in audit_list]
+    total_rate = sum(rates)
+    total_size = sum(sizes)
+    #Half the corruption chance comes from change, half from just having data on disk
+    hazards = []
+    for rate, size in zip(rates, sizes):
+        hazard = 0.0
+        if total_rate > 0:
+            hazard += 0.5 * rate / total_rate
+        if total_size > 0:
+            hazard += 0.5 * size / total_size
+        hazards.append(hazard)
+    if sum(hazards) == 0:
+        hazards = [1.0] * len(audit_list)
+    #Pre-generate the events, so every policy sees the same ones
+    event_rng = random.Random(seed)
+    events = []
+    for run in range(runs):
+        if event_rng.random() < events_per_run:
+            events.append((run, event_rng.choices(range(len(audit_list)), weights=hazards)[0]))
+    results = {}
+    for name, policy in policies.items():
+        policy_rng = random.Random(seed + 1)
+        sim_list = [item.copy() for item in audit_list]
+        for index, item in enumerate(sim_list):
+            item['index'] = index
+        pending = {}
+        delays = []
+        event_iter = iter(events)
+        next_event = next(event_iter, None)
+        for run in range(runs):
+            now = start + run * run_days * 86400
+            #Datasets keep changing between audits
+            for item, rate in zip(sim_list, rates):
+                if item['written'] != "":
+                    item['written'] = str(int(int(item['written']) + rate * run_days))
+            while next_event is not None and next_event[0] == run:
+                pending.setdefault(next_event[1], []).append(run)
+                next_event = next(event_iter, None)
+            chosen = policy(sim_list, now, policy_rng)[0]
+            chosen['checked'] = str(int(chosen['checked']) + 1)
+            chosen['last_checked'] = str(int(now))
+            chosen['written'] = "0"
+            if chosen['index'] in pending:
+                for event_run in pending.pop(chosen['index']):
+                    delays.append(run - event_run)
+                chosen['failures'] = str(int(chosen['failures']) + 1)
+        results[name] = {
+            "events": len(events),
+            "detected": len(delays),
+            "undetected": sum(len(runs_list) for runs_list in pending.values()),
+            "mean_days": sum(delays) / len(delays) if delays else 0.0
+        }
+    return results
 
 def get_latest_monthly(dataset, username) -> str:
     '''
@@ -178,28 +473,68 @@ def get_latest_monthly(dataset, username) -> str:
         raise
     return ssh_out.strip()
 
-def get_files(server, path, username) -> str:
+def get_audit_job(conf_path:str, dataset:dict) -> tuple[int, str]:
+    '''
+    Function to find the JobId of the last good Full backup of a dataset, and the Job's Fileset
+    Looks up the dataset's Job from the Bacula config files, then its last good Full from the Catalog
+    A Full is used rather than a later Diff, as a Diff only holds recently changed files
+    Returns a Tuple of "JobId", "Fileset name"
+    Raises LookupError if there is no Job, or no good Full
     '''
-    Function to get a random file list to test restore
+    for bacula_item in bf.get_config_index(conf_path):
+        if (bacula_item.bacula_client_server == dataset['server']
+                and bacula_item.bacula_file_path == dataset['path']):
+            job_name = bacula_item.bacula_job_name
+            fileset = bacula_item.bacula_fileset
+            break
+    else:
+        raise LookupError(f"No Bacula Job found for {dataset['path']} on {dataset['server']}")
+    last_jobs = bf.get_last_good_jobs(job_name)
+    if "F" not in last_jobs.get(job_name, {}):
+        raise LookupError(f"No good Full backup found for {job_name}")
+    return last_jobs[job_name]["F"]["jobid"], fileset
+
+def get_catalog_file(dataset:dict, snapshot_path:str, job_id:int, username:str,
+                     max_size:int, min_age_days:int) -> tuple[str, str, int]:
     '''
-    ssh_cmd = f"find {path} -type f -size -50M -mtime +35 | shuf -n1"
+    Function to pick a random file to test restore, from the files the Catalog says Job "job_id" backed up
+    Then checks the candidates exist in the ZFS snapshot, with a single SSH call
+    Returns a Tuple of "path as backed up", "path in the snapshot", "size in bytes"
+    Raises LookupError if none of the candidates are in the snapshot
+    '''
+    dataset_path = dataset['path'].rstrip("/")
+    snapshot_path = snapshot_path.rstrip("/")
+    candidates = {}
+    for backup_path, size in bf.get_job_files_sample(job_id, max_size, min_age_days):
+        if backup_path.startswith(dataset_path + "/"):
+            candidates[snapshot_path + backup_path[len(dataset_path):]] = (backup_path, size)
+    if len(candidates) == 0:
+        raise LookupError(f"No files in Job {job_id} match the size & age limits")
+    quoted = " ".join(shlex.quote(path) for path in candidates)
+    ssh_cmd = f"for f in {quoted}; do [ -f \"$f\" ] && printf '%s\\n' \"$f\"; done; true"
     try:
-        audit_file = subprocess.run(['ssh', f'{username}@{server}', ssh_cmd], capture_output=True,
-                                    text=True, check=True).stdout
+        existing = subprocess.run(['ssh', f'{username}@{dataset["server"]}', ssh_cmd], capture_output=True,
+                                  text=True, check=True).stdout.splitlines()
     except subprocess.CalledProcessError:
-        print(f"Error with SSH to {server}")
+        print(f"Error with SSH to {dataset['server']}")
         raise
-    return audit_file.strip()
+    existing = [path for path in existing if path in candidates]
+    if len(existing) == 0:
+        raise LookupError(f"None of the files sampled from Job {job_id} are in {snapshot_path}")
+    audit_file = random.choice(existing)
+    backup_path, size = candidates[audit_file]
+    return backup_path, audit_file, size
 
 def checksum_file(server, audit_file, username) -> str:
     '''
     Function to run sha1sum on file on either local or remote server
     '''
     if server != "local":
-        ssh_checksum_cmd = f"sha1sum {audit_file} | " + r"sed -e 's/^\(.\{40\}\).*/\1/'"
+        ssh_checksum_cmd = f"sha1sum {shlex.quote(audit_file)} | " + r"sed -e 's/^\(.\{40\}\).*/\1/'"
         audit_checksum = subprocess.run(['ssh', f'{username}@{server}', ssh_checksum_cmd],
                                         capture_output=True, text=True, check=True).stdout
-        return audit_checksum
+        #Strip the newline, so it compares with the local hexdigest
+        return audit_checksum.strip()
     else:
         #Taken from: https://www.geeksforgeeks.org/python-program-to-find-hash-of-file/
         hash_func = hashlib.new("sha1")
@@ -227,17 +562,52 @@ def ssh_zfs(server, username) -> list[tuple]:
         for zline in ssh_output:
             if zline != "none": #If the mountpoint isn't "none"
                 zfs_mountpoints.append(zline)
-        return list(tuple(filter(None,zfs_mountpoints)),server)
+        return [(mountpoint, server) for mountpoint in filter(None, zfs_mountpoints)]
     else:
         #ZFS output was empty - this is bad!
         raise ValueError(f"ZFS list from {server} was empty!")
 
+def zfs_stats(server:str, audit_items:list, username:str):
+    '''
+    Function to SSH on to a server and update the "size" and "written" fields of the Audit List items
+    "written" is bytes changed since the last audited snapshot, or since creation if never audited
+    Uses a single SSH call for all the datasets on the server
+    '''
+    if len(audit_items) == 0:
+        return
+    commands = []
+    for item in audit_items:
+        path = shlex.quote(item['path'])
+        if item['last_snapshot'] != "":
+            written_prop = shlex.quote("written@" + item['last_snapshot'])
+        else:
+            #Never audited, so everything counts as changed
+            written_prop = "used"
+        commands.append(f"printf '%s\\t%s\\t%s\\n' {path} \"$(zfs get -Hp -o value used {path})\" "
+                        f"\"$(zfs get -Hp -o value {written_prop} {path} 2>/dev/null)\"")
+    try:
+        ssh_output = subprocess.run(['ssh', f'{username}@{server}', "; ".join(commands)],
+                                    capture_output=True, text=True, check=True).stdout
+    except subprocess.CalledProcessError:
+        print(f"Error with SSH to {server}")
+        raise
+    for zline in ssh_output.splitlines():
+        zitem = zline.split("\t")
+        if len(zitem) != 3:
+            continue
+        #ZFS gives "-" (or nothing) if it doesn't know, e.g. the snapshot has been destroyed
+        changes = {}
+        if zitem[1].isdigit():
+            changes['size'] = zitem[1]
+        changes['written'] = zitem[2] if zitem[2].isdigit() else ""
+        audit_list_update(audit_items, zitem[0], **changes)
+
 def write_log(file:str, content:str):
     '''
     Function to write to a logfile
     Will create it if required, or append
     '''
-    line = "[" + datetime.now().strftime("%H:%M:%S") + "] " + content
+    line = "[" + datetime.now().strftime("%H:%M:%S") + "] " + str(content) + "\n"
     try:
         with open(file, "a", encoding="utf-8") as log_file: #Append will create if required
             log_file.write(line)
@@ -7,11 +7,216 @@ Optional: "-snapoff" (defaults to On) - use the FS Snapshot plugin
 "-schedule" - pick a pre-defined Schedule for the backup. If not set the job won't auto-run.
 "-bpath" - If you have Bacula installed somewhere weird.
 Assumes the client (i.e. the server we are backing up from) has already been added to Bacula!
+Can also be imported, create_backup_job / create_backup_jobs do the same without starting a new process.
 '''
 import argparse
+import glob
+import os
 import platform
+from dataclasses import dataclass, field
 import bacula_functions as bf
 
+### SCRATCH POOL & LIBRARY CHANGER ###
+SCRATCH_POOL = "Scratch"
+TAPE_CHANGER = "QuantumLib1"
+######################################
+SCHEDULES = ["First", "Second", "Third"]
+DEFAULT_BPATH = "/opt/bacula/etc/conf.d/Director/"
+
+class JobCreateError(Exception):
+    '''Base error for anything that stops a Job being created'''
+
+class JobExistsError(JobCreateError):
+    '''A Job (or its files) already exists for this dataset'''
+
+class JobSpecError(JobCreateError):
+    '''The Job details passed in aren't valid, e.g. unknown Schedule'''
+
+class ConfigCheckError(JobCreateError):
+    '''"bacula-dir -t" failed, either before starting or with the new files'''
+
+@dataclass
+class JobCreateResult():
+    '''
+    Dataclass for the result of creating a Job
+    "error" is None if the Job was created, otherwise the JobCreateError that stopped it
+    "reloaded" is the result of the Director reload, None if it wasn't reloaded
+    '''
+    job_name: str
+    fileset_name: str
+    files: list[str] = field(default_factory=list) #Config files written
+    previous: dict[str, str | None] = field(default_factory=dict) #File : contents before, None if it was new
+    error: JobCreateError | None = None
+    reloaded: bool | None = None
+
+def get_conf_path(bpath:str=DEFAULT_BPATH) -> str:
+    '''
+    Returns this Director's config folder under "bpath"
+    platform.node() gets the current host's name
+    '''
+    if not bpath.endswith("/"):
+        bpath = bpath + "/"
+    return bpath + platform.node().split(".")[0] + "-dir/"
+
+def _job_files(bacula_job:bf.BaculaJob, conf_path:str) -> list[str]:
+    '''
+    Returns the config files create_backup_job writes for a Job
+    The shared JobDefs is last, bf.check_create_def_job_def only writes it if it's missing
+    '''
+    return [conf_path + "Pool/" + bacula_job.set_name + "_full_pool.cfg",
+            conf_path + "Pool/" + bacula_job.set_name + "_diff_pool.cfg",
+            conf_path + "Fileset/" + bacula_job.bacula_fs_name + ".cfg",
+            conf_path + "Job/" + bacula_job.job_name + ".cfg",
+            conf_path + "JobDefs/Default_Tape_JD.cfg"]
+
+def _client_address(conf_path:str, client_name:str) -> str | None:
+    '''
+    Returns the Address from the Client file for "client_name", None if there isn't one
+    '''
+    for client_file in glob.glob(f'{conf_path}Client/*.cfg', recursive=False):
+        if bf.search_file(client_file, "Name") == client_name:
+            return bf.search_file(client_file, "Address")
+    return None
+
+def _read_files(files:list[str]) -> dict[str, str | None]:
+    '''
+    Backs up the contents of files we're about to write, None for any that don't exist yet
+    '''
+    previous = {}
+    for file in files:
+        try:
+            with open(file, 'r', encoding="utf-8") as old_file:
+                previous[file] = old_file.read()
+        except FileNotFoundError:
+            previous[file] = None
+    return previous
+
+def _restore_files(previous:dict[str, str | None]):
+    '''
+    Puts back files backed up by _read_files: existing files get their old contents,
+    files we created are removed (ignoring any that are already gone)
+    '''
+    for file, contents in previous.items():
+        if contents is None:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+        else:
+            #Writing over the top keeps the file's owner & permissions
+            with open(file, 'w', encoding="utf-8") as old_file:
+                old_file.write(contents)
+
+def _check(call_location:str):
+    '''
+    Calls bf.check_bacula, turning a failure into ConfigCheckError
+    '''
+    try:
+        bf.check_bacula(call_location)
+    except bf.BConsoleError as e:
+        raise ConfigCheckError(f"Bacula config check failed: {call_location}") from e
+
+def _write_job(server:str, path:str, setname:str, schedule:str | None, snapshot:bool,
+               conf_path:str, overwrite:bool) -> JobCreateResult:
+    '''
+    Validates the Job details and writes the Pool, Fileset & Job files for one Job
+    Doesn't check or reload Bacula. Returns a JobCreateResult, with "error" set if it failed
+    '''
+    server = server.split(".")[0]
+    bacula_job = bf.BaculaJob(server, setname, "zbkp_" + setname + "_fs", "zbkp_" + setname + "_job",
+                              path, schedule, snapshot, TAPE_CHANGER, SCRATCH_POOL)
+    result = JobCreateResult(bacula_job.job_name, bacula_job.bacula_fs_name)
+    if schedule is not None and schedule not in SCHEDULES:
+        result.error = JobSpecError(f"Unknown Schedule {schedule}, must be one of {SCHEDULES}")
+        return result
+    if not overwrite:
+        #The JobDefs is shared by every Job, so is expected to exist
+        existing = [file for file in _job_files(bacula_job, conf_path)[:-1] if os.path.exists(file)]
+        if any(item.bacula_job_name == bacula_job.job_name for item in bf.get_config_index(conf_path)):
+            existing.insert(0, bacula_job.job_name)
+        if existing:
+            result.error = JobExistsError(f"{bacula_job.job_name} already exists: {', '.join(existing)}")
+            return result
+    try:
+        result.previous = _read_files(_job_files(bacula_job, conf_path))
+        bf.check_create_def_job_def(bacula_job, conf_path)
+        bf.create_pool(bacula_job, conf_path)
+        bf.create_fileset(bacula_job, conf_path)
+        bf.create_job(bacula_job, conf_path)
+    except (IOError, LookupError) as e:
+        #LookupError - set_perms can't find the bacula user / group
+        _restore_files(result.previous)
+        result.error = JobCreateError(f"Error writing files for {bacula_job.job_name}: {e}")
+        return result
+    result.files = [file for file in _job_files(bacula_job, conf_path) if file in result.previous]
+    if result.previous[result.files[-1]] is not None:
+        #We didn't write the JobDefs
+        result.files.pop()
+    return result
+
+def create_backup_jobs(job_specs:list[dict], bpath:str=DEFAULT_BPATH, reload:bool=True,
+                       overwrite:bool=False) -> list[JobCreateResult]:
+    '''
+    Creates many Jobs in one go, with a single config check and a single Director reload
+    Each item of "job_specs" is a Dictionary of create_backup_job's arguments:
+    "server", "path", "setname", and optionally "schedule" & "snapshot"
+    Jobs that can't be created get a JobCreateResult with "error" set, the rest still go ahead
+    Raises ConfigCheckError if Bacula's config is bad before starting, or with the new files
+    (in which case new files are removed again, and overwritten files get their old contents back)
+    '''
+    conf_path = get_conf_path(bpath)
+    #Check that Bacula is happy before doing anything at all:
+    _check("Start of batch, no action taken")
+    try:
+        #Read the existing config once up front, the index is shared by every Job in the batch
+        bf.get_config_index(conf_path)
+    except KeyError as e:
+        raise ConfigCheckError(f"Can't read the existing Bacula config: {e}") from e
+    results = []
+    for spec in job_specs:
+        results.append(_write_job(spec["server"], spec["path"], spec["setname"], spec.get("schedule"),
+                                  spec.get("snapshot", True), conf_path, overwrite))
+    created = [result for result in results if result.error is None]
+    if not created:
+        return results
+    try:
+        _check(f"Created files for {len(created)} Jobs")
+    except ConfigCheckError:
+        #Newest first, in case a batch wrote the same file twice
+        for result in reversed(created):
+            _restore_files(result.previous)
+        raise
+    for spec, result in zip(job_specs, results):
+        if result.error is None:
+            #Same as a refresh of the index would give: the Address may differ from "server" (e.g. FQDN),
+            #and no Schedule is written as "None"
+            client_name = spec["server"].split(".")[0] + "-fd"
+            address = _client_address(conf_path, client_name)
+            bf.add_to_config_index(conf_path, bf.BaculaInfo(
+                client_name, result.fileset_name, f"{spec.get('schedule')}", spec["path"],
+                address if address is not None else spec["server"], result.job_name))
+    if reload:
+        try:
+            reloaded = bf.reload_bacula()
+        except bf.BConsoleError:
+            reloaded = False
+        for result in created:
+            result.reloaded = reloaded
+    return results
+
+def create_backup_job(server:str, path:str, setname:str, schedule:str | None=None, snapshot:bool=True,
+                      bpath:str=DEFAULT_BPATH, reload:bool=True, overwrite:bool=False) -> JobCreateResult:
+    '''
+    Creates the Pool, Fileset & Job files for one dataset, checks the config and reloads the Director
+    Raises JobCreateError (or a subclass) if the Job can't be created
+    '''
+    result = create_backup_jobs([{"server": server, "path": path, "setname": setname,
+                                  "schedule": schedule, "snapshot": snapshot}],
+                                bpath, reload, overwrite)[0]
+    if result.error is not None:
+        raise result.error
+    return result
+
 def main():
     '''
     Parses the variables passed in, calls the appropriate other parts!
@@ -22,83 +227,43 @@ def main():
         required=True)
     parser.add_argument("-setname", help="ZFS pool name", required=True)
     parser.add_argument("-schedule", help="The schedule to be used, if not set it won't run",
-        choices=["First", "Second", "Third"])
+        choices=SCHEDULES)
     parser.add_argument("-snapoff",
         help="Do not use ZFS Snapshots for this backup set (Boolean switch)",
         action="store_true")
     parser.add_argument("-bpath",
         help="Path to the Bacula Config Folder - defaults to /opt/bacula/etc/conf.d/Director/",
-        default="/opt/bacula/etc/conf.d/Director/")
+        default=DEFAULT_BPATH)
     args = parser.parse_args()
-    ### SCRATCH POOL & LIBRARY CHANGER ###
-    scratch_pool = "Scratch"
-    tape_changer = "QuantumLib1"
-    ######################################
-    #Check that Bacula is happy before doing anything at all:
-    try:
-        bf.check_bacula("Start of script, no action taken")
-    except bf.BConsoleError as e:
-        print("Error checking Bacula Config before starting!")
-        print(e)
-        raise e
-    #We assume now that Bacula is already happy, and we can go ahead with creating things
-    #Set the Bacula Configuration Folder path
-    # platform.node() gets the current host's name
-    if args.bpath.endswith("/"):
-        conf_path = args.bpath + platform.node().split(".")[0] + "-dir/"
-    else:
-        conf_path = args.bpath + "/" + platform.node().split(".")[0] + "-dir/"
-    if args.snapoff:
-        #Snapoff is set!
-        snapshot = False
-    else:
-        snapshot = True
-    server = args.server.split(".")[0]
-    #Set Bacula Job Class things:
-    bacula_job = bf.BaculaJob(server, args.setname, "zbkp_" + args.setname + "_fs",
-                           "zbkp_" + args.setname + "_job", args.path, args.schedule, snapshot,
-                           tape_changer, scratch_pool)
-    bf.create_pool(bacula_job, conf_path)
-    try:
-        bf.check_bacula("Created Pool files")
-    except bf.BConsoleError as e:
-        print("Error with Bacula Config, created pool files")
-        print(e)
-        raise
-    bf.create_fileset(bacula_job, conf_path)
     try:
-        bf.check_bacula("Created Fileset Files")
-    except bf.BConsoleError as e:
-        print("Error with Fileset Files")
+        result = create_backup_job(args.server, args.path, args.setname, args.schedule,
+                                   not args.snapoff, args.bpath)
+    except ConfigCheckError as e:
+        print("Error with Bacula Config!")
         print(e)
         raise
-    bf.create_job(bacula_job, conf_path)
-    try:
-        bf.check_bacula("Created Fileset and Job files")
-    except bf.BConsoleError as e:
-        print("Error with Job Files")
-        print(e)
+    except JobCreateError as e:
+        print(f"Error creating Job: {e}")
         raise
+    if result.reloaded:
+        #The reload picked up the new Job, no need to restart the Director
+        raise SystemExit
+    restarted = False
     try:
-        reloaded = bf.reload_bacula()
-        restarted = bf.bacula_restart
-    except bf.subprocess.CalledProcessError:
+        #Only restarts if no Jobs are active
+        restarted = bf.bacula_restart()
+    except (bf.subprocess.CalledProcessError, bf.BConsoleError):
         print("!!!!!!!!!!!!!!!!!!!!")
         print("!!! WARNING !!!")
-        print("Something went wrong when running 'systemctl restart bacula-dir'")
-        print("You MUST check this manually!")
+        print("Bacula refused to Reload, and something went wrong restarting the Director")
+        print("You MUST check this manually, the new Job has not been loaded!")
         print("!!!!!!!!!!!!!!!!!!!!")
+        raise SystemExit
     if not restarted:
         print("!!!Alert!!!")
-        print("Jobs are running, so the Director has not been restarted")
-        if reloaded:
-            print("This is probably fine, but you should run 'systemctl restart bacula-dir' manually",
-                "once the current jobs are finished.")
-        else:
-            #Reloaded is False, so it's not so fine...
-            print("!!! In addition, Bacula refused to Reload, so new items have not been loaded !!!")
-            print("!!! You will need to restart the Bacula Director manually for them to appear !!!")
-            print("!!! Use the command 'systemctl restart bacula-dir' once running jobs are completed !!!")
+        print("!!! Bacula refused to Reload, and Jobs are running, so the Director has not been restarted !!!")
+        print("!!! You will need to restart the Bacula Director manually for new items to appear !!!")
+        print("!!! Use the command 'systemctl restart bacula-dir' once running jobs are completed !!!")
     raise SystemExit
 if __name__ == '__main__':
     main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+'''
+Script to forecast how many tapes the per-dataset Full & Diff Pools will pin over the coming months
+Uses the Pool retention from bacula_functions (as create_pool writes it), each Job's Schedule,
+ZFS sizes and the growth of each Job's Fulls in the Catalog
+Prints Volumes needed and Scratch Volumes left per month
+Optional: "-months" - how far ahead to forecast (default 12)
+"-capacity" - Tape capacity, e.g. 12T (default 12T, LTO-8 native)
+"-full-retention" / "-diff-retention" - try different Volume Retention (days) instead of the current values
+"-onboard" - size (e.g. 200T) of a dataset that is about to be added, can be given more than once
+"-full-days" / "-diff-days" - days between Fulls / Diffs (default 30 / 7), used for every Schedule
+"-nozfs" - don't SSH to the servers, use the size of each Job's last Fulls instead
+'''
+import argparse
+import math
+import platform
+from dataclasses import dataclass
+import bacula_functions as bf
+from bacula_job_check import size_convert, size_format, ssh_zfs
+
+#Default days between Fulls & Diffs, assumed for every Job with a Schedule
+#The Schedule resources aren't read, use "-full-days" / "-diff-days" if they're different
+DEFAULT_CYCLE = {"full_days" : 30, "diff_days" : 7}
+#Schedule values for Jobs that don't auto-run (bacula_create writes "None")
+NO_SCHEDULE = (None, "", "None")
+#Diff size as a fraction of the dataset, if the Catalog has no Diffs for a Job
+DEFAULT_DIFF_FRACTION = 0.1
+#Average days in a month, for stepping the forecast
+MONTH_DAYS = 30.44
+
+@dataclass
+class JobGrowth():
+    '''
+    Dataclass for the inputs to the forecast for one Job (and its Full & Diff Pools)
+    '''
+    job_name: str #Name of the Bacula Job
+    schedule: str #Schedule, one of NO_SCHEDULE if the Job doesn't auto-run
+    size_b: int #Size of a Full now, in bytes
+    growth_b: float #Growth of a Full, in bytes per day
+    diff_b: int #Size of a Diff, in bytes
+    onboard: bool = False #Not added yet, so has no backups on tape
+
+def pool_bytes(size_b:float, growth_b:float, period_days:float, retention_days:float, day:float,
+               held_days:float=0) -> float:
+    '''
+    Bytes held on a Pool's unexpired Volumes "day" days from now
+    Backups are every "period_days", Volumes are pinned for "retention_days" after they're written
+    "held_days" is how many days of backups the Pool already holds now (0 for a new Job),
+    anything past that has to build up, one backup per period from day 0
+    Backup size grows by "growth_b" per day, summed in one go rather than backup by backup
+    '''
+    held = max(math.ceil(held_days / period_days) - 1, 0)
+    count = min(math.ceil(retention_days / period_days), held + math.floor(day / period_days) + 1)
+    #Backups at day, day - period, ..., day - (count - 1) * period
+    latest = size_b + growth_b * day
+    if latest <= 0:
+        return 0.0
+    if growth_b > 0:
+        #Don't count backups from before the dataset (by the fit) had anything in it
+        count = min(count, math.ceil(latest / (growth_b * period_days)))
+    total = count * latest - growth_b * period_days * count * (count - 1) / 2
+    return max(total, 0.0)
+
+def forecast(jobs:list[JobGrowth], months:int, capacity_b:int, full_retention_days:float,
+             diff_retention_days:float, cycle:dict=None) -> tuple[list[int], dict[str, int]]:
+    '''
+    Forecasts the Volumes pinned by every Job's Full & Diff Pools at the start of each month
+    Each Pool has its own Volumes, so a part-filled Volume still counts as a whole one
+    Existing Jobs start with the backups the current Pool retention (bf.POOL_RETENTION) holds,
+    onboarded Jobs start with none
+    Every Job with a Schedule is backed up on "cycle" (defaults to DEFAULT_CYCLE)
+    Jobs without a Schedule don't write anything new, so aren't counted
+    Returns a Tuple of "Volumes per month (month 0 is now)", "Pool name : Volumes at the last month"
+    '''
+    if months < 0:
+        raise ValueError("Can't forecast a negative number of months")
+    if cycle is None:
+        cycle = DEFAULT_CYCLE
+    totals = [0] * (months + 1)
+    last_month = {}
+    held_full_days = int(bf.POOL_RETENTION["full"]["VolumeRetention"]) / 86400
+    held_diff_days = int(bf.POOL_RETENTION["diff"]["VolumeRetention"]) / 86400
+    for job in jobs:
+        if job.schedule in NO_SCHEDULE:
+            continue
+        set_name = job.job_name.removeprefix("zbkp_").removesuffix("_job")
+        held_full, held_diff = (0, 0) if job.onboard else (held_full_days, held_diff_days)
+        for month in range(months + 1):
+            day = month * MONTH_DAYS
+            full_volumes = math.ceil(pool_bytes(job.size_b, job.growth_b, cycle["full_days"],
+                                                full_retention_days, day, held_full) / capacity_b)
+            diff_volumes = math.ceil(pool_bytes(job.diff_b, 0, cycle["diff_days"],
+                                                diff_retention_days, day, held_diff) / capacity_b)
+            totals[month] += full_volumes + diff_volumes
+        last_month[f"{set_name}_pool_full"] = full_volumes
+        last_month[f"{set_name}_pool_diff"] = diff_volumes
+    return totals, last_month
+
+def build_jobs(bacula_info_list:list[bf.BaculaInfo], history:dict, zfs_sizes:dict) -> list[JobGrowth]:
+    '''
+    Combines the Job config, Catalog history (bf.get_job_history) and ZFS sizes (Server + Path : bytes)
+    Falls back to the average Full from the Catalog if there's no ZFS size
+    '''
+    jobs = []
+    for bacula_item in bacula_info_list:
+        levels = history.get(bacula_item.bacula_job_name, {})
+        full = levels.get("F", {"avgbytes": 0, "slope": 0.0})
+        size_b = zfs_sizes.get((bacula_item.bacula_client_server, bacula_item.bacula_file_path),
+                               full["avgbytes"])
+        if "D" in levels:
+            diff_b = levels["D"]["avgbytes"]
+        else:
+            diff_b = int(size_b * DEFAULT_DIFF_FRACTION)
+        #Shrinking datasets are assumed to stay the same size
+        jobs.append(JobGrowth(bacula_item.bacula_job_name, bacula_item.bacula_schedule, size_b,
+                              max(full["slope"], 0.0), diff_b))
+    return jobs
+
+def non_negative(value:str) -> int:
+    '''
+    argparse type for whole numbers that can't be negative
+    '''
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} must be 0 or more")
+    return number
+
+def positive(value:str) -> float:
+    '''
+    argparse type for numbers of days that must be more than 0
+    '''
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"{value} must be more than 0")
+    return number
+
+def main():
+    '''
+    Gets the Job config, Catalog history & ZFS sizes, then prints the forecast
+    '''
+    parser = argparse.ArgumentParser(description="Bacula Tape Pool Forecast Script.")
+    parser.add_argument("-months", help="Months to forecast", type=non_negative, default=12)
+    parser.add_argument("-capacity", help="Tape capacity (e.g. 12T)", default="12T")
+    parser.add_argument("-full-retention", help="Full Volume Retention to try, in days", type=float,
+        default=int(bf.POOL_RETENTION["full"]["VolumeRetention"]) / 86400)
+    parser.add_argument("-diff-retention", help="Diff Volume Retention to try, in days", type=float,
+        default=int(bf.POOL_RETENTION["diff"]["VolumeRetention"]) / 86400)
+    parser.add_argument("-onboard", help="Size of a dataset to be added (e.g. 200T)", action="append",
+        default=[])
+    parser.add_argument("-full-days", help="Days between Fulls, for every Schedule", type=positive,
+        default=DEFAULT_CYCLE["full_days"])
+    parser.add_argument("-diff-days", help="Days between Diffs, for every Schedule", type=positive,
+        default=DEFAULT_CYCLE["diff_days"])
+    parser.add_argument("-nozfs", help="Don't SSH to the servers for ZFS sizes (Boolean switch)",
+        action="store_true")
+    args = parser.parse_args()
+    #Variables:
+    bacula_path = "/opt/bacula/etc/conf.d/Director/" + platform.node().split(".")[0] + "-dir/"
+    server_list = [ '<SERVER 3>',
+                   '<SERVER 2>',
+                   '<More Servers...>'
+                   ]
+    scratch_pool = "Scratch"
+    capacity_b = size_convert(args.capacity)
+    bacula_info_list = bf.get_bacula_config(bacula_path)
+    history = bf.get_job_history()
+    pool_volumes = bf.get_pool_volumes()
+    scratch_volumes = pool_volumes.get(scratch_pool, 0)
+    zfs_sizes = {}
+    if not args.nozfs:
+        #Must be changed to use SSH key!
+        username = input("Enter SSH username:")
+        for zfs in ssh_zfs(server_list, username):
+            zfs_sizes[(zfs.server, zfs.mount)] = zfs.size_b
+    jobs = build_jobs(bacula_info_list, history, zfs_sizes)
+    for number, size in enumerate(args.onboard):
+        size_b = size_convert(size)
+        #Onboarded datasets are assumed to be Scheduled
+        jobs.append(JobGrowth(f"zbkp_onboard{number}_job", "Onboard", size_b, 0.0,
+                              int(size_b * DEFAULT_DIFF_FRACTION), onboard=True))
+    totals, last_month = forecast(jobs, args.months, capacity_b, args.full_retention, args.diff_retention,
+                                  {"full_days": args.full_days, "diff_days": args.diff_days})
+    #Volumes the forecast Pools hold in the Catalog now, anything more comes out of Scratch
+    in_use = sum(pool_volumes.get(pool, 0) for pool in last_month)
+    print(f"{len(jobs)} Jobs, {size_format(capacity_b)} tapes, Full retention {args.full_retention:.0f} days, "
+          f"Diff retention {args.diff_retention:.0f} days, {in_use} Volumes in use, "
+          f"{scratch_volumes} Volumes in {scratch_pool}")
+    print("Month  Volumes  Scratch left")
+    scratch_left = scratch_volumes
+    for month, volumes in enumerate(totals):
+        previous_left = scratch_left
+        scratch_left = scratch_volumes - max(volumes - in_use, 0)
+        print(f"{month:>5}  {volumes:>7}  {scratch_left:>12}")
+        if scratch_left < 0 <= previous_left:
+            print(f"!!! {scratch_pool} runs out in month {month} !!!")
+    print("\nLargest Pools at the end of the forecast:")
+    for pool, volumes in sorted(last_month.items(), key=lambda item: item[1], reverse=True)[:10]:
+        print(f"  {pool}: {volumes} Volumes")
+
+if __name__ == '__main__':
+    main()
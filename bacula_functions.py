@@ -1,5 +1,6 @@
 '''Library of Bacula Functions for Python'''
 import subprocess
+import glob
 from dataclasses import dataclass
 import os
 import shutil
@@ -8,6 +9,29 @@ import smtplib
 import platform
 from email.message import EmailMessage
 import re
+import threading
+import time
+import uuid
+
+#Job status codes (from the Catalog / bconsole) for jobs that have finished
+TERMINATED_STATUS = ("T", "W", "E", "e", "f", "A", "I")
+#Job status codes for jobs that haven't started yet: created, waiting on their start time,
+#a higher priority Job, Max Jobs limits, or for the Client / Storage to be free
+#Anything else that hasn't finished has started, even if it's now waiting (e.g. to mount a tape)
+QUEUED_STATUS = ("C", "t", "p", "d", "j", "c", "s", "F", "S", "q")
+
+#Per-dataset Pool retention (seconds), see create_pool
+POOL_RETENTION = {
+    "full" : {"JobRetention" : "18144000", "VolumeRetention" : "20736000"},
+    "diff" : {"JobRetention" : "12960000", "VolumeRetention" : "15552000"}
+}
+
+#Cache for the Director status, so multiple callers in one run share one query
+_status_cache = {"time": 0.0, "status": None}
+#Process-wide bconsole session, see get_bconsole_session
+_bconsole_session = {"session": None}
+#Process-wide index of the Bacula config files, Director config path : list of BaculaInfo
+_config_index = {}
 
 class BConsoleError(Exception):
     '''Bacula Console Error - don't do anything, just another Exception'''
@@ -22,6 +46,7 @@ class BaculaInfo():
     bacula_schedule: str
     bacula_file_path: str
     bacula_client_server: str
+    bacula_job_name: str = "" #Name of the Bacula Job
 
 @dataclass
 class BaculaJob():
@@ -38,6 +63,37 @@ class BaculaJob():
     autochanger: str #Tape Autochanger to be used
     scratch: str #Scratch Pool
 
+@dataclass
+class BaculaJobStatus():
+    '''
+    Dataclass for the status of a single Job as reported by the Director
+    Times are Epoch seconds, or None if the Director doesn't report one (e.g. not started yet)
+    '''
+    job_id: int #JobId
+    job: str #Unique Job name (Name.Date_Time)
+    name: str #Name of the Bacula Job
+    type: str #Job Type (B = Backup, R = Restore...)
+    level: str #Job Level (F = Full, D = Diff, I = Incr)
+    status: str #Job Status code (R = Running, T = Terminated OK...)
+    job_bytes: int #Bytes written so far / in total
+    job_files: int #Files written so far / in total
+    errors: int #Number of errors
+    sched_time: int | None #Scheduled time
+    start_time: int | None #Start time
+    end_time: int | None #End time
+
+@dataclass
+class DirectorStatus():
+    '''
+    Dataclass for the Director's Job status, split into running, queued & recently terminated Jobs
+    "running" includes started Jobs that are waiting (e.g. for a tape to be mounted),
+    "queued" is Jobs that haven't started yet (see QUEUED_STATUS)
+    '''
+    running: list[BaculaJobStatus]
+    queued: list[BaculaJobStatus]
+    terminated: list[BaculaJobStatus]
+    query_time: float #Epoch time the Director was asked
+
 def error_email(error_message:str, email_address:(str | list)):
     '''
     Small function to call other email function
@@ -113,15 +169,11 @@ def create_pool(bacula_job: BaculaJob, conf_path):
     The Tapes are Recycled after the Volume Retention period
     '''
     pool_dict = {
-        "full" : {
-            "path" : conf_path + "Pool/" + bacula_job.set_name + "_full_pool.cfg",
-            "JobRetention" : "18144000",
-            "VolumeRetention" : "20736000"
+        "full" : POOL_RETENTION["full"] | {
+            "path" : conf_path + "Pool/" + bacula_job.set_name + "_full_pool.cfg"
         },
-        "diff" : {
-            "path" : conf_path + "Pool/" + bacula_job.set_name + "_diff_pool.cfg",
-            "JobRetention" : "12960000",
-            "VolumeRetention" : "15552000"
+        "diff" : POOL_RETENTION["diff"] | {
+            "path" : conf_path + "Pool/" + bacula_job.set_name + "_diff_pool.cfg"
         }
     }
     for diff_full, values in pool_dict.items():
@@ -141,7 +193,7 @@ def create_pool(bacula_job: BaculaJob, conf_path):
                 pool_file.write('}\n')
             set_perms(values["path"], "bacula", "bacula")
         except IOError as exc:
-            raise(f"Error writing {values['path']}") from exc
+            raise IOError(f"Error writing {values['path']}") from exc
 
 def check_create_def_job_def(bacula_job: BaculaJob, conf_path):
     '''
@@ -170,7 +222,7 @@ def check_create_def_job_def(bacula_job: BaculaJob, conf_path):
                 jdfile.write("}\n")
             set_perms(jd_path, "bacula", "bacula")
         except IOError as exc:
-            raise(f"Error writing {jd_path}") from exc
+            raise IOError(f"Error writing {jd_path}") from exc
 
 def create_fileset(bacula_job:BaculaJob, conf_path):
     '''
@@ -196,7 +248,7 @@ def create_fileset(bacula_job:BaculaJob, conf_path):
             fsfile.write('}\n')
         set_perms(fs_file_name, "bacula", "bacula")
     except IOError as exc:
-        raise(f"Error writing {fs_file_name}") from exc
+        raise IOError(f"Error writing {fs_file_name}") from exc
 
 def create_job(bacula_job: BaculaJob, conf_path):
     '''
@@ -220,7 +272,7 @@ def create_job(bacula_job: BaculaJob, conf_path):
             jobfile.write('}\n')
         set_perms(jobname, "bacula", "bacula")
     except IOError as exc:
-        raise(f"Error writing {jobname}") from exc
+        raise IOError(f"Error writing {jobname}") from exc
 
 def check_bacula(call_location):
     '''
@@ -241,35 +293,325 @@ def check_bacula(call_location):
 def reload_bacula() -> bool:
     '''
     Just a wrapper to reload Bacula to read the newly created files.
-    "echo reload | /opt/bacula/bin/bconsole" is the command
+    "reload" in bconsole is the command (through the session if one is running)
     Returns "True" if no error was logged, or False / raise an error if it was.
     '''
-    reload_command = 'echo "reload" | /opt/bacula/bin/bconsole'
-    try:
-        result = subprocess.run(reload_command, check=True, shell=True, stdout=subprocess.PIPE)
-        if "Please correct" in str(result):
-            raise BConsoleError("Bad config, please check")
-    except (subprocess.CalledProcessError, BConsoleError) as exception:
-        raise BConsoleError from exception
-    if result.returncode != 0:
-        #In case the Try doesn't work...
-        raise BConsoleError(result.stdout)
-    if "Request ignored" in str(result.stdout):
+    result = bconsole_command(["reload"])
+    if "Please correct" in result:
+        raise BConsoleError("Bad config, please check")
+    #Jobs may have changed, so anything cached is now out of date
+    clear_status_cache()
+    if "Request ignored" in result:
         return False
     else:
         return True
 
+class BConsoleSession():
+    '''
+    A long-running bconsole process, so many commands don't each pay for starting bconsole
+    and connecting to the Director
+    After each batch of commands an "@echo <marker>" is sent, and output is read up to the marker
+    '''
+    def __init__(self, bc_bin:str="/opt/bacula/bin/bconsole"):
+        self.bc_bin = bc_bin
+        self.process = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        '''
+        Starts bconsole, if it isn't already running
+        '''
+        if self.process is not None and self.process.poll() is None:
+            return
+        try:
+            self.process = subprocess.Popen([self.bc_bin], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        except OSError as e:
+            raise BConsoleError("Error starting bconsole") from e
+
+    def command(self, commands:list[str]) -> str:
+        '''
+        Runs one or more commands in the session, returns their output
+        Raises BConsoleError if bconsole has gone away
+        '''
+        with self.lock:
+            self.open()
+            marker = f"END-{uuid.uuid4().hex}"
+            try:
+                self.process.stdin.write("\n".join(commands) + f"\n@echo {marker}\n")
+                self.process.stdin.flush()
+            except OSError as e:
+                self.close()
+                raise BConsoleError("Error writing to bconsole") from e
+            output = []
+            while True:
+                line = self.process.stdout.readline()
+                if line == "":
+                    #EOF - bconsole has exited
+                    self.close()
+                    raise BConsoleError("bconsole exited unexpectedly:\n" + "".join(output))
+                if line.strip() == marker:
+                    break
+                output.append(line)
+            return "".join(output)
+
+    def close(self):
+        '''
+        Stops bconsole
+        '''
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+        self.process = None
+
+def get_bconsole_session() -> BConsoleSession:
+    '''
+    Returns the process-wide bconsole session, starting it if required
+    Once started, bconsole_command (and everything using it) runs through this session
+    '''
+    if _bconsole_session["session"] is None:
+        _bconsole_session["session"] = BConsoleSession()
+    _bconsole_session["session"].open()
+    return _bconsole_session["session"]
+
+def close_bconsole_session():
+    '''
+    Stops the process-wide bconsole session, bconsole_command goes back to one bconsole per call
+    '''
+    if _bconsole_session["session"] is not None:
+        _bconsole_session["session"].close()
+        _bconsole_session["session"] = None
+
+def bconsole_command(commands:list[str], use_session:bool=True) -> str:
+    '''
+    Runs one or more bconsole commands in a single bconsole call
+    Uses the process-wide session if one has been started (see get_bconsole_session),
+    set "use_session" to False for long-running commands (e.g. "wait") that shouldn't hold it up
+    Returns the stdout from bconsole, raises BConsoleError if bconsole fails
+    '''
+    if use_session and _bconsole_session["session"] is not None:
+        return _bconsole_session["session"].command(commands)
+    bc_bin = "/opt/bacula/bin/bconsole"
+    try:
+        result = subprocess.run([bc_bin], input="\n".join(commands) + "\n", stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    except subprocess.CalledProcessError as e:
+        raise BConsoleError("Error running bconsole") from e
+    return result.stdout
+
+def parse_api_output(output:str) -> list[dict]:
+    '''
+    Parses bconsole ".api 2" output, which is blocks of "key=value" lines separated by blank lines
+    Returns a list of Dictionaries, one per block
+    '''
+    records = []
+    record = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if line == "":
+            if record:
+                records.append(record)
+                record = {}
+            continue
+        if "=" not in line:
+            #Prompts, headers, etc. - not part of a record
+            continue
+        key, value = line.split("=", 1)
+        record[key.strip()] = value.strip()
+    if record:
+        records.append(record)
+    return records
+
+def _status_int(record:dict, *keys) -> int | None:
+    '''
+    Returns the first of "keys" found in "record" as an int, or None if there isn't one
+    Bacula reports "0" for times it doesn't know, so treat that as None too
+    '''
+    for key in keys:
+        value = record.get(key, "")
+        if value.isdigit() and int(value) != 0:
+            return int(value)
+    return None
+
+def get_director_status(max_age:int=30, refresh:bool=False) -> DirectorStatus:
+    '''
+    Function to get the running, queued and recently terminated Jobs from the Director
+    Uses the ".api 2" dot-commands, so Job names with spaces don't break anything
+    The result is cached for "max_age" seconds so multiple callers share one bconsole call,
+    set "refresh" to True to always ask the Director
+    '''
+    now = time.time()
+    if (not refresh and _status_cache["status"] is not None
+            and now - _status_cache["time"] < max_age):
+        return _status_cache["status"]
+    output = bconsole_command([".api 2", ".status dir running", ".status dir terminated"])
+    running = []
+    queued = []
+    terminated = []
+    jobs = {}
+    for record in parse_api_output(output):
+        if not record.get("jobid", "").isdigit() or "status" not in record:
+            #Header or other non-Job block
+            continue
+        job_status = BaculaJobStatus(
+            int(record["jobid"]), record.get("job", ""), record.get("name", ""),
+            record.get("type", ""), record.get("level", ""), record["status"],
+            _status_int(record, "jobbytes") or 0, _status_int(record, "jobfiles") or 0,
+            _status_int(record, "errors") or 0,
+            _status_int(record, "schedtime_epoch", "sched_time_epoch"),
+            _status_int(record, "starttime_epoch", "start_time_epoch"),
+            _status_int(record, "endtime_epoch", "end_time_epoch"))
+        #A Job can finish between the two commands, keep the later (terminated) record
+        jobs[job_status.job_id] = job_status
+    for job_status in jobs.values():
+        if job_status.status in TERMINATED_STATUS:
+            terminated.append(job_status)
+        elif job_status.status in QUEUED_STATUS:
+            queued.append(job_status)
+        else:
+            #Running, or started and waiting on a tape / Storage / Client etc.
+            running.append(job_status)
+    status = DirectorStatus(running, queued, terminated, now)
+    _status_cache["time"] = now
+    _status_cache["status"] = status
+    return status
+
+def clear_status_cache():
+    '''
+    Clears the cached Director status, so the next call to get_director_status asks the Director
+    '''
+    _status_cache["time"] = 0.0
+    _status_cache["status"] = None
+
+def catalog_query(query:str, columns:list[str]) -> list[dict]:
+    '''
+    Runs an SQL query against the Catalog via the bconsole ".sql" command
+    ".sql" prints each row as tab-separated values with no header, so "columns" names the
+    values in the order of the SELECT list. Needs at least 2 columns, so rows can be told apart
+    from bconsole's prompts and the echoed command (which have no tabs)
+    Returns a list of Dictionaries, one per row, keyed by "columns"
+    Raises BConsoleError if the Catalog reports an error, rather than returning no rows
+    Query must not contain double-quotes, as it is passed to bconsole inside them
+    '''
+    if "\"" in query:
+        raise ValueError("Catalog query can't contain double-quotes")
+    if len(columns) < 2:
+        raise ValueError("Catalog query must select at least 2 columns")
+    output = bconsole_command([f'.sql query="{query}"'])
+    rows = []
+    for line in output.splitlines():
+        if line.startswith(".sql"):
+            #Echoed command
+            continue
+        if "\t" not in line and ("Query failed" in line or "ERR=" in line):
+            raise BConsoleError(f"Catalog query failed: {line.strip()}")
+        values = line.split("\t")
+        if len(values) == len(columns) + 1 and values[-1].strip() == "":
+            #Trailing tab
+            values = values[:-1]
+        if len(values) != len(columns):
+            #Prompts, "Using Catalog" etc.
+            continue
+        rows.append(dict(zip(columns, [value.strip() for value in values])))
+    return rows
+
+def get_last_good_jobs(name_pattern:str="zbkp_%_job") -> dict[str, dict]:
+    '''
+    Function to get the last successful Full & Diff backup for every Job matching "name_pattern"
+    Uses a single Catalog query, no matter how many Jobs there are
+    Returns a Dictionary of Job Name : {Level : {"jobid", "jobbytes", "jobfiles", "endtime"}}
+    "endtime" is a datetime
+    '''
+    query = ("SELECT j.Name AS name, j.Level AS level, j.JobId AS jobid, j.JobBytes AS jobbytes, "
+             "j.JobFiles AS jobfiles, j.EndTime AS endtime FROM Job j JOIN "
+             "(SELECT Name, Level, MAX(JobId) AS JobId FROM Job WHERE Type = 'B' "
+             "AND JobStatus IN ('T', 'W') AND Level IN ('F', 'D') "
+             f"AND Name LIKE '{name_pattern}' GROUP BY Name, Level) l ON j.JobId = l.JobId")
+    last_jobs = {}
+    for row in catalog_query(query, ["name", "level", "jobid", "jobbytes", "jobfiles", "endtime"]):
+        last_jobs.setdefault(row["name"], {})[row["level"]] = {
+            "jobid": int(row["jobid"]),
+            "jobbytes": int(row["jobbytes"]),
+            "jobfiles": int(row["jobfiles"]),
+            #Drop any fractional seconds
+            "endtime": datetime.strptime(row["endtime"][:19], "%Y-%m-%d %H:%M:%S")
+        }
+    return last_jobs
+
+def get_job_history(days:int=400, name_pattern:str="zbkp_%_job") -> dict[str, dict]:
+    '''
+    Function to summarise the good Full & Diff backups of every Job matching "name_pattern" over the last "days"
+    Uses a single Catalog query (PostgreSQL, for regr_slope)
+    Returns a Dictionary of Job Name : {Level : {"jobs", "avgbytes", "slope"}}
+    "slope" is the growth in JobBytes per day, from a linear fit over the period
+    '''
+    query = ("SELECT Name AS name, Level AS level, count(*) AS jobs, round(avg(JobBytes)) AS avgbytes, "
+             "coalesce(regr_slope(JobBytes, EXTRACT(EPOCH FROM EndTime)), 0) AS slope FROM Job "
+             "WHERE Type = 'B' AND JobStatus IN ('T', 'W') AND Level IN ('F', 'D') "
+             f"AND Name LIKE '{name_pattern}' AND EndTime > now() - interval '{int(days)} days' "
+             "GROUP BY Name, Level")
+    history = {}
+    for row in catalog_query(query, ["name", "level", "jobs", "avgbytes", "slope"]):
+        history.setdefault(row["name"], {})[row["level"]] = {
+            "jobs": int(row["jobs"]),
+            "avgbytes": int(float(row["avgbytes"])),
+            "slope": float(row["slope"]) * 86400
+        }
+    return history
+
+def get_pool_volumes() -> dict[str, int]:
+    '''
+    Function to count the Volumes in every Pool from the Catalog, in a single query
+    Returns a Dictionary of Pool Name : Volumes, Pools without any Volumes aren't included
+    '''
+    query = ("SELECT p.Name AS name, count(*) AS volumes FROM Media m JOIN Pool p ON m.PoolId = p.PoolId "
+             "GROUP BY p.Name")
+    return {row["name"]: int(row["volumes"]) for row in catalog_query(query, ["name", "volumes"])}
+
+def get_job_files_sample(job_id:int, max_size:int, min_age_days:int, count:int=20) -> list[tuple[str, int]]:
+    '''
+    Function to get a random sample of files backed up by a Job, from the Catalog File & Path tables
+    Only files between 1 byte and "max_size" bytes, last modified more than "min_age_days" ago
+    Picks "count" x 10 independent random FileIds in the Job's range (each the next File row at or
+    after a random point), so only those rows have their LStat decoded with Bacula's
+    base64_decode_lstat (PostgreSQL Catalog) for the size & age filters
+    Returns a list of tuples of "full path", "size in bytes", up to "count" long
+    '''
+    cutoff = int(time.time()) - min_age_days * 86400
+    job_id = int(job_id)
+    query = (f"WITH r AS (SELECT min(FileId) AS lo, max(FileId) AS hi FROM File WHERE JobId = {job_id}), "
+             "t AS MATERIALIZED (SELECT r.lo + floor(random() * (r.hi - r.lo + 1))::bigint AS target "
+             f"FROM r, generate_series(1, {int(count) * 10})), "
+             "s AS (SELECT DISTINCT f.PathId, f.Filename, f.LStat FROM t CROSS JOIN LATERAL "
+             f"(SELECT PathId, Filename, LStat FROM File WHERE JobId = {job_id} AND FileId >= t.target "
+             "ORDER BY FileId LIMIT 1) f WHERE f.Filename <> ''), "
+             "c AS (SELECT PathId, Filename, base64_decode_lstat(8, LStat) AS size, "
+             "base64_decode_lstat(12, LStat) AS mtime FROM s) "
+             "SELECT p.Path AS path, c.Filename AS filename, c.size AS size FROM c "
+             f"JOIN Path p ON p.PathId = c.PathId WHERE c.size BETWEEN 1 AND {int(max_size)} "
+             f"AND c.mtime < {cutoff} ORDER BY random() LIMIT {int(count)}")
+    return [(row["path"] + row["filename"], int(row["size"]))
+            for row in catalog_query(query, ["path", "filename", "size"])]
+
 def search_file(filename, search_string) -> str:
     '''
     Function to search a given file for a string
     Returns the value from the item searched for (assumes format of '<item> = "<value>"')
-    Will return the <value> from between the ""
+    Will return the <value> from between the "", or everything after the = if it isn't quoted
     '''
     try:
         with open(filename, 'r', encoding='utf-8') as searching_file:
             for line in enumerate(searching_file):
                 if search_string in line[1]:
-                    return line[1].split("\"")[1]
+                    if "\"" in line[1]:
+                        return line[1].split("\"")[1]
+                    return line[1].split("=", 1)[1].strip()
         return None #If we don't find anything, return None
     except IOError as e:
         raise e
@@ -286,10 +628,12 @@ def get_bacula_info(job_file_list, fileset_file_list, client_file_list) -> list[
     ## Adding in additional Search items:
     #Get info from Job Files
     for job_file in job_file_list:
+        jf_name = search_file(job_file, "Name")
         jf_client = search_file(job_file, "Client")
         jf_fileset = search_file(job_file, "Fileset")
         jf_schedule = search_file(job_file, "Schedule")
-        jobs_info.append({"Client": f"{jf_client}", "Fileset": f"{jf_fileset}", "Schedule": f"{jf_schedule}"})
+        jobs_info.append({"Name": f"{jf_name}", "Client": f"{jf_client}", "Fileset": f"{jf_fileset}",
+                          "Schedule": f"{jf_schedule}"})
     #Get info from Fileset Files:
     for fileset_file in fileset_file_list:
         fs_name = search_file(fileset_file, "Name")
@@ -305,31 +649,159 @@ def get_bacula_info(job_file_list, fileset_file_list, client_file_list) -> list[
         try:
             address = client_file_info[job_entry["Client"]][0]
         except KeyError as exc:
-            raise KeyError(f"{job_entry["Client"]} - Client File doesn't exist") from exc
+            raise KeyError(f"{job_entry["Name"]}: {job_entry["Client"]} - Client File doesn't exist") from exc
         try:
             path = fileset_info[job_entry["Fileset"]][0]
         except KeyError as exc:
-            raise KeyError(f"{job_entry["Fileset"]} - Fileset file doesn't exist") from exc
+            raise KeyError(f"{job_entry["Name"]}: {job_entry["Fileset"]} - Fileset file doesn't exist") from exc
         info_list.append(BaculaInfo(job_entry["Client"], job_entry["Fileset"],
-                                    job_entry["Schedule"], path, address))
+                                    job_entry["Schedule"], path, address, job_entry["Name"]))
     return info_list
 
-def bacula_restore(src_serv:str, file:str, source_folder:str,
-                restore_folder:str, res_client="localhost") -> tuple[str, str]:
+def get_bacula_config(conf_path:str) -> list[BaculaInfo]:
+    '''
+    Function to read the Job, Fileset & Client files under a Director's config path
+    (e.g. /opt/bacula/etc/conf.d/Director/<host>-dir/)
+    Returns a list of BaculaInfo type items, see get_bacula_info
+    '''
+    if not conf_path.endswith("/"):
+        conf_path = conf_path + "/"
+    job_file_list = glob.glob(f'{conf_path}Job/*.cfg', recursive=False)
+    fileset_file_list = glob.glob(f'{conf_path}Fileset/*.cfg', recursive=False)
+    client_file_list = glob.glob(f'{conf_path}Client/*.cfg', recursive=False)
+    return get_bacula_info(job_file_list, fileset_file_list, client_file_list)
+
+def get_config_index(conf_path:str, refresh:bool=False) -> list[BaculaInfo]:
+    '''
+    Returns the process-wide index of a Director's config files (see get_bacula_config)
+    The files are only read the first time, or if "refresh" is True
+    '''
+    if refresh or conf_path not in _config_index:
+        _config_index[conf_path] = get_bacula_config(conf_path)
+    return _config_index[conf_path]
+
+def add_to_config_index(conf_path:str, bacula_info:BaculaInfo):
+    '''
+    Adds a newly created Job to the config index, if the index for that Director has been read
+    '''
+    if conf_path in _config_index:
+        _config_index[conf_path].append(bacula_info)
+
+def clear_config_index(conf_path:str):
+    '''
+    Drops a Director from the config index, so it's read again next time (e.g. after files are removed)
+    '''
+    _config_index.pop(conf_path, None)
+
+def _is_referenced(config_text:dict[str, str], name:str, exclude:list[str]) -> bool:
+    '''
+    Checks if the resource "name" appears (quoted or not) in any config file, apart from those in "exclude"
+    '''
+    pattern = re.compile(rf'(?<![\w.-]){re.escape(name)}(?![\w.-])')
+    return any(pattern.search(text) for file, text in config_text.items() if file not in exclude)
+
+def find_orphaned_resources(conf_path:str,
+                            live_datasets:set[tuple[str, str]]) -> tuple[dict[str, list[str]], list[str]]:
+    '''
+    Function to find the Job, Fileset & Pool files made by create_backup_job ("zbkp_" Jobs)
+    for datasets that no longer exist
+    "live_datasets" is a set of (Server, Mountpoint) from ZFS. Only Jobs for Servers in it are checked
+    Jobs whose Client Address can't be found are never orphans, they're returned to be checked by hand
+    Also finds Fileset & Pool files left behind without their Job
+    Filesets & Pools still named in any other resource file (Jobs, JobDefs, Schedule overrides etc.)
+    are left alone
+    Returns a Tuple of "Job (or set) name : list of files to archive", "Jobs with an unknown Client"
+    '''
+    if not conf_path.endswith("/"):
+        conf_path = conf_path + "/"
+    live_servers = {server for server, _mount in live_datasets}
+    client_address = {}
+    for client_file in glob.glob(f'{conf_path}Client/*.cfg', recursive=False):
+        client_address[search_file(client_file, "Name")] = search_file(client_file, "Address")
+    config_text = {}
+    for config_file in glob.glob(f'{conf_path}**/*.cfg', recursive=True):
+        with open(config_file, 'r', encoding='utf-8') as searching_file:
+            config_text[config_file] = searching_file.read()
+    orphans = {}
+    unresolved = []
+    job_sets = set()
+    for job_file in glob.glob(f'{conf_path}Job/zbkp_*_job.cfg', recursive=False):
+        job_name = os.path.basename(job_file)[:-len(".cfg")]
+        set_name = job_name[len("zbkp_"):-len("_job")]
+        job_sets.add(set_name)
+        fileset_name = search_file(job_file, 'Fileset')
+        fileset_file = conf_path + "Fileset/" + f"{fileset_name}.cfg"
+        path = search_file(fileset_file, "File ") if os.path.exists(fileset_file) else None
+        address = client_address.get(search_file(job_file, "Client"))
+        if address is None:
+            #Can't tell which Server the dataset was on
+            unresolved.append(job_name)
+            continue
+        if address not in live_servers:
+            continue
+        #No Fileset means the Job can't run anyway
+        if path is None or (address, path) not in live_datasets:
+            resources = {fileset_name: fileset_file}
+            for level in ("full", "diff"):
+                resources[f"{set_name}_pool_{level}"] = conf_path + "Pool/" + f"{set_name}_{level}_pool.cfg"
+            set_files = [job_file] + list(resources.values())
+            orphans[job_name] = [job_file] + [file for name, file in resources.items() if os.path.exists(file)
+                                              and not _is_referenced(config_text, name, set_files)]
+    #Filesets & Pools whose Job has already gone (and nothing else uses)
+    leftovers = {}
+    for fileset_file in glob.glob(f'{conf_path}Fileset/zbkp_*_fs.cfg', recursive=False):
+        set_name = os.path.basename(fileset_file)[len("zbkp_"):-len("_fs.cfg")]
+        leftovers.setdefault(set_name, {})[f"zbkp_{set_name}_fs"] = fileset_file
+    for pool_file in glob.glob(f'{conf_path}Pool/*_pool.cfg', recursive=False):
+        pool_match = re.fullmatch(r'(.+)_(full|diff)_pool\.cfg', os.path.basename(pool_file))
+        if pool_match is not None:
+            leftovers.setdefault(pool_match[1], {})[f"{pool_match[1]}_pool_{pool_match[2]}"] = pool_file
+    for set_name, resources in sorted(leftovers.items()):
+        if set_name in job_sets:
+            continue
+        set_files = list(resources.values())
+        files = [file for name, file in resources.items() if not _is_referenced(config_text, name, set_files)]
+        if files:
+            orphans[set_name] = files
+    return orphans, unresolved
+
+def archive_resources(files:list[str], conf_path:str, archive_path:str) -> list[tuple[str, str]]:
+    '''
+    Moves config files out of the Director's config folder into "archive_path", keeping their
+    Job/Fileset/Pool sub-folder. Returns a list of (original, archived) paths for restore_resources
+    '''
+    moved = []
+    try:
+        for file in files:
+            archived = os.path.join(archive_path, os.path.relpath(file, conf_path))
+            os.makedirs(os.path.dirname(archived), exist_ok=True)
+            shutil.move(file, archived)
+            moved.append((file, archived))
+    except OSError as exc:
+        restore_resources(moved)
+        raise IOError(f"Error archiving {file}") from exc
+    clear_config_index(conf_path)
+    return moved
+
+def restore_resources(moved:list[tuple[str, str]]):
+    '''
+    Puts files moved by archive_resources back where they were
+    '''
+    for original, archived in moved:
+        shutil.move(archived, original)
+
+def bacula_restore(src_serv:str, file:str, source_folder:str, restore_folder:str,
+                   res_client="localhost", fileset:str=None) -> tuple[str, str]:
     #https://www.bacula.org/15.0.x-manuals/en/console/Bacula_Enterprise_Console.html#784
-    # May be able to use "wait" along with JobID?
     '''
     Function to create Bacula Restore job
     Takes "Source Servername", "File to restore", "Source File Path", "Restore folder path",
-    "Restore client (if not specified then defaults to Director)"
-    Returns a Tuple of "str: Restore Status", "str: JobID=<ID>"
+    "Restore client (if not specified then defaults to Director)",
+    "Fileset (if not specified Bacula will ask if the Client has more than one)"
     Returns a Tuple of "str: Restore Status", "str: JobID=<ID>"
-    should wait for job, if the job fails then should notify by email
+    Waits for the Job, then reads its status from the Catalog by JobId rather than from
+    ".messages", so several restores can run at the same time
     '''
-    #set "restore_status" now, so if it's not in the messages we handle it
-    restore_status = "ERROR"
-    #set "restore_status" now, so if it's not in the messages we handle it
-    restore_status = "ERROR"
     if res_client == "localhost":
         res_client = platform.node().split(".")[0] + "-fd"
     else:
@@ -339,65 +811,46 @@ def bacula_restore(src_serv:str, file:str, source_folder:str,
         source_folder = source_folder + "/"
     if not restore_folder.endswith("/"):
         restore_folder = restore_folder + "/"
-    bc_bin = "/opt/bacula/bin/bconsole"
-    bacula_params = (f"restore client={src_serv}-fd restoreclient={res_client} file={file} "
-        "strip_prefix={source_folder} add_prefix={restore_folder} current done wait yes")
-    #Run "Messages" to clear it first...
-    subprocess.run(f"echo -e .messages | {bc_bin}", shell=True,stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
-    bacula_params = (f"restore client={src_serv}-fd restoreclient={res_client} file={file} "
-        "strip_prefix={source_folder} add_prefix={restore_folder} current done wait yes")
-    bcmd = f"echo -e {bacula_params} | {bc_bin}"
-    try:
-        result = subprocess.run(bcmd, shell=True, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
-        #Try doesn't necessarily return errors from bconsole, but returncode should.
-        result = subprocess.run(bcmd, shell=True, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
-        #Try doesn't necessarily return errors from bconsole, but returncode should.
-        if result.returncode != 0:
-            raise BConsoleError(result.stdout)
-        restore_jobid = re.search(r"JobId=\d\d", result.stdout)[0]
-        messages = subprocess.run(f"echo -e .messages | {bc_bin}", shell=True,stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
-    except (subprocess.CalledProcessError, BConsoleError) as exception:
-        raise BConsoleError from exception
-    messages_list = messages.stdout.strip().split("\n")
-    for item in messages_list:
-        #Look for the "Termination" line and return that as the Restore_Status
-        if "Termination:" in item:
-            restore_status = item.split(":")[1].lstrip()
+    bacula_params = (f'restore client={src_serv}-fd restoreclient={res_client} file="{file}" '
+                     f'strip_prefix="{source_folder}" add_prefix="{restore_folder}" ')
+    if fileset is not None:
+        bacula_params = bacula_params + f'fileset="{fileset}" '
+    bacula_params = bacula_params + "current done yes"
+    #Not through the session - each restore gets its own bconsole, so they don't queue behind each other
+    output = bconsole_command([bacula_params], use_session=False)
+    jobid_match = re.search(r"JobId=(\d+)", output)
+    if jobid_match is None:
+        raise BConsoleError(f"Restore Job not started:\n{output}")
+    restore_jobid = jobid_match[0]
+    bconsole_command([f"wait jobid={jobid_match[1]}"], use_session=False)
+    rows = catalog_query(f"SELECT JobId, JobStatus FROM Job WHERE JobId = {jobid_match[1]}",
+                         ["jobid", "status"])
+    job_status = rows[0]["status"] if rows else ""
+    if job_status == "T":
+        restore_status = "Restore OK"
+    elif job_status == "W":
+        restore_status = "Restore OK -- with warnings"
+    else:
+        restore_status = f"Restore Error (JobStatus {job_status})"
     return restore_status, restore_jobid
 
 def bacula_restart() -> bool:
     '''
-    Function to check if any jobs are running
-    If no jobs are running try to restart the Director and return True if successful.
-    If jobs are running then returns False and doesn't try.
+    Function to check if any jobs are running or queued
+    If no jobs are running or queued try to restart the Director and return True if successful.
+    If jobs are running or queued then returns False and doesn't try.
     '''
-    bc_bin = "/opt/bacula/bin/bconsole"
-    running_jobs = []
-    try:
-        result = subprocess.run(f"echo -e .status dir running | {bc_bin}", shell=True,stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, universal_newlines=True, check=True)
-        if result.returncode != 0:
-            raise BConsoleError(result.stdout)
-    except (subprocess.CalledProcessError, BConsoleError) as e:
-        raise BConsoleError("Error running bconsole") from e
-    messages = result.stdout.splitlines()
-    for line in messages:
-        if "is running" in line:
-            running_job = line.split()
-            running_jobs.append({"JobID": running_job[0], "Type": running_job[1],
-                                "Level": running_job[2], "Files": running_job[3],
-                                "Bytes": running_job[4] + running_job[5], "Name": running_job[6]})
-    if len(running_jobs) > 0:
-        #List has something, so we have running jobs
+    #Always ask the Director, we don't want to restart over a Job that just started
+    director_status = get_director_status(refresh=True)
+    if len(director_status.running + director_status.queued) > 0:
+        #List has something, so we have running or queued jobs
         return False
     else:
         #List is empty, so nothing is running - restart the Director
         result = subprocess.run("systemctl restart bacula-dir", shell=True, stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        #The Director has been restarted, so anything cached is now out of date
+        clear_status_cache()
         if result.returncode != 0:
             raise subprocess.CalledProcessError
         #Systemctl doesn't necessarily fail when the restart does. Check if it's now running.
@@ -1,10 +1,20 @@
 #!/usr/bin/python3
 '''
 Script to check for Bacula Jobs for datasets
+Optional: "-report" - instead of just missing Jobs, email a freshness & coverage report
+"-stale" - Days since the last good Full/Diff before a Job counts as stale (default 35)
+"-directors" - check several Directors' config folders (local paths, or host:path to fetch with scp)
+against the same ZFS datasets, and email one report
+"-prune" - archive the Job, Fileset & Pool files of datasets that no longer exist, then check & reload Bacula once
+"-dry-run" - with "-prune", only list what would be archived
 '''
-import glob
+import argparse
+from datetime import datetime
+import os
 import platform
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 import bacula_functions as bf
 
@@ -37,6 +47,17 @@ def size_convert(size):
             size_b = float(size[:-1])*1000*1000*1000*1000
     return(int(size_b))
 
+def size_format(size_b:int) -> str:
+    '''
+    Converts (Decimal) Bytes back to a string with K/M/G/T on the end, the opposite of size_convert
+    '''
+    size = float(size_b)
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1000:
+            return f"{size:.1f}{unit}"
+        size = size / 1000
+    return f"{size:.1f}T"
+
 def ssh_zfs(servers, username):
     '''
     Function to SSH on to servers, get ZFS output, return list of ZFS output
@@ -55,15 +76,183 @@ def ssh_zfs(servers, username):
             #Zitem = [0]Used(string with T/G/M/K), [1]Mountpoint, [2]Dataset-name
             if (len(zitem) >1): #Skip over any empty ones
                 size = size_convert(zitem[0])
-                ztemp = ZFSOutput(size, zitem[0], zitem[1], zitem[2], server)
+                ztemp = ZFSOutput(zitem[0], size, zitem[1], zitem[2], server)
                 zfs_output.append(ztemp)
     return zfs_output
 
+def coverage_report(zfs_list:list[ZFSOutput], bacula_info_list:list[bf.BaculaInfo],
+                    last_jobs:dict, stale_days:int) -> str:
+    '''
+    Function to build the freshness & coverage report
+    Joins the ZFS datasets to their Bacula Job, and the Job to its last good Full/Diff
+    (from bf.get_last_good_jobs), returns the report as a string for emailing
+    A dataset is "protected" if it has a Job with a good Full/Diff within "stale_days"
+    '''
+    now = datetime.now()
+    #Index the Jobs by Server + Path, so we don't loop over every Job for every dataset
+    job_index = {}
+    for bacula_item in bacula_info_list:
+        job_index[(bacula_item.bacula_client_server, bacula_item.bacula_file_path)] = bacula_item
+    no_job = []
+    never_run = []
+    stale = []
+    server_bytes = {}
+    for zfs in zfs_list:
+        totals = server_bytes.setdefault(zfs.server, {"protected": 0, "unprotected": 0})
+        bacula_item = job_index.get((zfs.server, zfs.mount))
+        if bacula_item is None:
+            no_job.append(zfs)
+            totals["unprotected"] += zfs.size_b
+            continue
+        levels = last_jobs.get(bacula_item.bacula_job_name, {})
+        if not levels:
+            never_run.append((zfs, bacula_item.bacula_job_name))
+            totals["unprotected"] += zfs.size_b
+            continue
+        last_good = max(job["endtime"] for job in levels.values())
+        age = (now - last_good).days
+        if age > stale_days:
+            stale.append((zfs, bacula_item.bacula_job_name, last_good, age))
+            totals["unprotected"] += zfs.size_b
+        else:
+            totals["protected"] += zfs.size_b
+    body = f"Bacula backup coverage report - {now.strftime('%Y-%m-%d %H:%M')}\n\n"
+    body = body + f"Stale Jobs (no good Full/Diff in {stale_days} days):\n"
+    for zfs, job_name, last_good, age in sorted(stale, key=lambda item: item[3], reverse=True):
+        body = body + (f"  {job_name} ({zfs.dataset} on {zfs.server}) - last good backup "
+                       f"{last_good.strftime('%Y-%m-%d')}, {age} days ago\n")
+    body = body + "\nJobs that have never had a good Full/Diff:\n"
+    for zfs, job_name in never_run:
+        body = body + f"  {job_name} ({zfs.dataset} on {zfs.server})\n"
+    body = body + "\nNo Bacula job found for the following filesystems:\n"
+    for zfs in no_job:
+        body = body + f"  {zfs.dataset} on {zfs.server}\n"
+    body = body + "\nProtected / Unprotected bytes per server:\n"
+    for server, totals in sorted(server_bytes.items()):
+        body = body + (f"  {server}: {size_format(totals['protected'])} protected, "
+                       f"{size_format(totals['unprotected'])} unprotected\n")
+    return body
+
+def load_director_config(director:str, username:str, work_dir:str) -> list[bf.BaculaInfo]:
+    '''
+    Function to read a Director's Job, Fileset & Client config files
+    "director" is either a local config path, or "host:path" to copy the files from with scp first
+    Returns a list of BaculaInfo, see bf.get_bacula_config
+    '''
+    if os.path.isdir(director) or ":" not in director:
+        return bf.get_bacula_config(director)
+    host, remote_path = director.split(":", 1)
+    if not remote_path.endswith("/"):
+        remote_path = remote_path + "/"
+    #A folder of its own, as more than one Director can be on the same host
+    local_path = tempfile.mkdtemp(prefix=f"{host}-", dir=work_dir) + "/"
+    sources = [f"{username}@{host}:{remote_path}{folder}" for folder in ["Job", "Fileset", "Client"]]
+    try:
+        subprocess.run(['scp', '-rq'] + sources + [local_path], capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Error copying config from {host}")
+        raise e
+    return bf.get_bacula_config(local_path)
+
+def multi_director_report(zfs_list:list[ZFSOutput], director_info:dict[str, list[bf.BaculaInfo]],
+                          director_errors:dict[str, str]=None) -> str:
+    '''
+    Function to build the consolidated report for several Directors
+    Lists datasets with no Job on any Director, and datasets with more than one Job (on one or more Directors)
+    "director_errors" is Director : error for any whose config couldn't be read, they're listed as not checked
+    and "missing" only covers the Directors in "director_info"
+    Returns an empty string if there is nothing to report
+    '''
+    if director_errors is None:
+        director_errors = {}
+    #Index every Director's Jobs by Server + Path
+    job_index = {}
+    for director, bacula_info_list in director_info.items():
+        for bacula_item in bacula_info_list:
+            job_index.setdefault((bacula_item.bacula_client_server, bacula_item.bacula_file_path),
+                                 []).append((director, bacula_item.bacula_job_name))
+    missing = []
+    duplicated = []
+    for zfs in zfs_list:
+        jobs = job_index.get((zfs.server, zfs.mount), [])
+        if len(jobs) == 0:
+            missing.append(zfs)
+        elif len(jobs) > 1:
+            duplicated.append((zfs, jobs))
+    body = ""
+    for director, error in director_errors.items():
+        body = body + f"!!! Director {director} was not checked: {error} !!!\n"
+    if director_errors:
+        body = body + "\n"
+    if missing and director_info:
+        body = body + f"No Bacula job found on any of the {len(director_info)} Directors checked for:\n"
+        for zfs in missing:
+            body = body + f"  {zfs.dataset} on {zfs.server}\n"
+    if duplicated:
+        body = body + "\nDatasets backed up more than once:\n"
+        for zfs, jobs in duplicated:
+            job_list = ", ".join(f"{job_name} ({director})" for director, job_name in jobs)
+            body = body + f"  {zfs.dataset} on {zfs.server}: {job_list}\n"
+    return body
+
+def prune_orphans(bacula_path:str, zfs_list:list[ZFSOutput], archive_path:str, dry_run:bool=False) -> str:
+    '''
+    Function to archive the config files of Jobs for datasets that no longer exist
+    Everything is moved in one batch, then Bacula is checked once and reloaded once
+    If the check fails the files are put back. Jobs that are running or queued are left alone,
+    as are Jobs whose Client Address can't be found (they're listed to check by hand)
+    Returns a summary of what was (or would be) archived
+    '''
+    orphans, unresolved = bf.find_orphaned_resources(bacula_path,
+                                                     {(zfs.server, zfs.mount) for zfs in zfs_list})
+    #These stop get_bacula_config (and so the normal check) working, until they're fixed by hand
+    unresolved_body = "".join(f"Skipping {name}, can't find its Client's Address (missing Client file?) "
+                              "- remove the Job or add the Client back by hand\n" for name in unresolved)
+    if len(orphans) == 0:
+        return unresolved_body
+    director_status = bf.get_director_status(refresh=True)
+    active = {job.name for job in director_status.running + director_status.queued}
+    body = unresolved_body
+    files = []
+    for name, orphan_files in sorted(orphans.items()):
+        if name in active:
+            body = body + f"Skipping {name}, it is running or queued\n"
+            continue
+        body = body + f"{name}:\n" + "".join(f"  {file}\n" for file in orphan_files)
+        files.extend(orphan_files)
+    if dry_run or len(files) == 0:
+        return body
+    archive_path = os.path.join(archive_path, datetime.now().strftime('%Y-%m-%d-%H%M%S'))
+    moved = bf.archive_resources(files, bacula_path, archive_path)
+    try:
+        bf.check_bacula(f"Archived {len(moved)} orphaned files to {archive_path}")
+    except bf.BConsoleError:
+        bf.restore_resources(moved)
+        raise
+    if not bf.reload_bacula():
+        body = body + "\n!!! Bacula refused to Reload, restart the Director once running jobs are completed !!!\n"
+    return f"Archived to {archive_path}:\n" + body
+
 def main():
     '''
     Main script, calls functions from bacula_functions
     Will check for Jobs for Datasets, email if there are sets with no job
+    With "-report" emails the freshness & coverage report instead
     '''
+    parser = argparse.ArgumentParser(description="Bacula Job Check Script.")
+    parser.add_argument("-report", help="Email a freshness & coverage report (Boolean switch)",
+        action="store_true")
+    parser.add_argument("-stale", help="Days without a good Full/Diff before a Job is stale",
+        type=int, default=35)
+    parser.add_argument("-directors", help="Director config folders to check together (path or host:path)",
+        nargs="+")
+    parser.add_argument("-prune", help="Archive config files for datasets that no longer exist (Boolean switch)",
+        action="store_true")
+    parser.add_argument("-dry-run", help="With -prune, only list what would be archived (Boolean switch)",
+        action="store_true")
+    parser.add_argument("-archive", help="Where -prune moves files to",
+        default="/opt/bacula/etc/archive/")
+    args = parser.parse_args()
     #Variables:
     bacula_info_list = [] #List for combined Bacula info
     bacula_path = "/opt/bacula/etc/conf.d/Director/" + platform.node() + "-dir/"
@@ -72,14 +261,55 @@ def main():
                    '<More Servers...>' 
                    ]
     email_address = "<NOTIFICATION EMAIL>"
-    #Get File listings:
-    job_file_list = glob.glob(f'{bacula_path}Job/*.cfg', recursive=False)
-    fileset_file_list = glob.glob(f'{bacula_path}Fileset/*.cfg', recursive=False)
-    client_file_list = glob.glob(f'{bacula_path}Client/*.cfg', recursive=False)
-    bacula_info_list = bf.get_bacula_info(job_file_list, fileset_file_list, client_file_list)
     #Must be changed to use SSH key!
     username = input("Enter SSH username:")
+    if args.directors:
+        #Fetch every Director's config and the ZFS datasets at the same time
+        with tempfile.TemporaryDirectory() as work_dir, ThreadPoolExecutor() as executor:
+            zfs_future = executor.submit(ssh_zfs, server_list, username)
+            director_futures = {director: executor.submit(load_director_config, director, username, work_dir)
+                                for director in args.directors}
+            director_info = {}
+            director_errors = {}
+            for director, future in director_futures.items():
+                try:
+                    director_info[director] = future.result()
+                except (subprocess.CalledProcessError, KeyError, OSError) as e:
+                    #One bad Director shouldn't stop the report for the rest
+                    director_errors[director] = str(e)
+            ssh_zfs_list = zfs_future.result()
+        body = multi_director_report(ssh_zfs_list, director_info, director_errors)
+        if body != "":
+            bf.send_email(email_address, "Missing / Duplicate Bacula Jobs!", body)
+        return
+    if args.prune:
+        #Prune first, as a missing Client file makes get_bacula_config fail
+        body = prune_orphans(bacula_path, ssh_zfs(server_list, username), args.archive, args.dry_run)
+        if args.dry_run:
+            print(body if body != "" else "Nothing to prune")
+        elif body != "":
+            bf.send_email(email_address, "Orphaned Bacula Jobs archived", body)
+        return
+    #Get info from the Bacula config files:
+    try:
+        bacula_info_list = bf.get_bacula_config(bacula_path)
+    except KeyError as e:
+        #A Job whose Client / Fileset file is gone, -prune won't archive it without the Client's Address
+        bf.send_email(email_address, "Bacula Job check failed",
+                      f"Can't read the Bacula config, fix this Job by hand:\n{e}")
+        raise
     ssh_zfs_list = ssh_zfs(server_list, username)
+    if args.report:
+        #One Catalog query for every Job's last good backup
+        try:
+            last_jobs = bf.get_last_good_jobs()
+        except bf.BConsoleError as e:
+            #Without the Catalog every Job would look like it had never run
+            bf.send_email(email_address, "Bacula Coverage Report failed", f"Catalog query failed:\n{e}")
+            raise
+        body = coverage_report(ssh_zfs_list, bacula_info_list, last_jobs, args.stale)
+        bf.send_email(email_address, "Bacula Backup Coverage Report", body)
+        return
     #Having now gotten the Bacula info and ZFS info, check if jobs exist for each dataset...
     for zfs in ssh_zfs_list.copy():
         for bacula_item in bacula_info_list:
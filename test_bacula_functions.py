@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+'''
+Tests for the Catalog & Director status parsing, and the orphaned config search, in bacula_functions
+bconsole is replaced with output captured from ".sql" & ".api 2", so no Director is needed
+Run with: python3 -m unittest test_bacula_functions
+'''
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+import bacula_functions as bf
+
+#Captured from bconsole: the echoed command, "Using Catalog", then raw tab-separated rows
+LAST_JOBS_OUTPUT = (
+    '.sql query="SELECT j.Name AS name, ..."\n'
+    'Using Catalog "MyCatalog"\n'
+    "zbkp_seblab_job\tF\t1204\t4398046511104\t1834221\t2026-09-01 02:14:07\n"
+    "zbkp_seblab_job\tD\t1290\t21474836480\t10233\t2026-09-29 01:02:55.123\n"
+    "zbkp_other_job\tF\t1250\t1099511627776\t52001\t2026-09-03 04:00:00\t\n"
+    "*"
+)
+HISTORY_OUTPUT = (
+    '.sql query="SELECT j.Name AS name, ..."\n'
+    "zbkp_seblab_job\tF\t12\t4300000000000.5\t0.00012\n"
+    "zbkp_seblab_job\tD\t40\t20000000000\t0\n"
+)
+#Captured from bconsole when the Catalog rejects the query
+QUERY_FAILED_OUTPUT = (
+    '.sql query="SELECT j.Name AS name, ..."\n'
+    'Using Catalog "MyCatalog"\n'
+    "Query failed: SELECT j.Name AS name, j.Level AS level FROM Jobs j: "
+    'ERR=ERROR:  relation "jobs" does not exist\n'
+    "LINE 1: SELECT j.Name AS name, j.Level AS level FROM Jobs j\n"
+    "                                                      ^\n"
+)
+
+#Captured from bconsole: ".api 2", ".status dir running", ".status dir terminated"
+#JobId 1312 finished between the two commands, so is in both lists
+STATUS_OUTPUT = (
+    ".api 2\n"
+    "api=2\n"
+    ".status dir running\n"
+    "\n"
+    "jobid=1310\n"
+    "job=zbkp_seblab_job.2026-10-19_01.00.00_04\n"
+    "name=zbkp_seblab_job\n"
+    "type=B\n"
+    "level=F\n"
+    "status=R\n"
+    "jobbytes=1099511627776\n"
+    "jobfiles=52001\n"
+    "errors=0\n"
+    "schedtime_epoch=1792371600\n"
+    "starttime_epoch=1792371602\n"
+    "\n"
+    "jobid=1311\n"
+    "job=Restore Files.2026-10-19_09.12.40_05\n"
+    "name=Restore Files\n"
+    "type=R\n"
+    "level=F\n"
+    "status=M\n"
+    "jobbytes=0\n"
+    "jobfiles=0\n"
+    "starttime_epoch=1792401161\n"
+    "\n"
+    "jobid=1313\n"
+    "job=zbkp_other_job.2026-10-19_09.30.00_07\n"
+    "name=zbkp_other_job\n"
+    "type=B\n"
+    "level=D\n"
+    "status=t\n"
+    "schedtime_epoch=1792402200\n"
+    "starttime_epoch=0\n"
+    "\n"
+    "jobid=1312\n"
+    "job=zbkp_third_job.2026-10-19_09.00.00_06\n"
+    "name=zbkp_third_job\n"
+    "type=B\n"
+    "level=D\n"
+    "status=R\n"
+    "starttime_epoch=1792400400\n"
+    "\n"
+    ".status dir terminated\n"
+    "\n"
+    "jobid=1312\n"
+    "job=zbkp_third_job.2026-10-19_09.00.00_06\n"
+    "name=zbkp_third_job\n"
+    "type=B\n"
+    "level=D\n"
+    "status=T\n"
+    "jobbytes=21474836480\n"
+    "jobfiles=10233\n"
+    "errors=0\n"
+    "starttime_epoch=1792400400\n"
+    "endtime_epoch=1792401900\n"
+    "\n"
+    "jobid=1290\n"
+    "job=zbkp_seblab_job.2026-09-29_01.00.00_03\n"
+    "name=zbkp_seblab_job\n"
+    "type=B\n"
+    "level=D\n"
+    "status=W\n"
+    "starttime_epoch=1790643600\n"
+    "endtime_epoch=1790643775\n"
+)
+
+class CatalogQueryTest(unittest.TestCase):
+    '''
+    catalog_query and the functions built on it
+    '''
+    def test_rows_by_position(self):
+        with mock.patch.object(bf, "bconsole_command", return_value=LAST_JOBS_OUTPUT):
+            rows = bf.catalog_query("SELECT 1", ["name", "level", "jobid", "jobbytes", "jobfiles", "endtime"])
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0], {"name": "zbkp_seblab_job", "level": "F", "jobid": "1204",
+                                   "jobbytes": "4398046511104", "jobfiles": "1834221",
+                                   "endtime": "2026-09-01 02:14:07"})
+        self.assertEqual(rows[2]["endtime"], "2026-09-03 04:00:00")
+
+    def test_wrong_column_count(self):
+        #Rows with a different number of fields to the SELECT list are dropped
+        with mock.patch.object(bf, "bconsole_command", return_value=LAST_JOBS_OUTPUT):
+            self.assertEqual(bf.catalog_query("SELECT 1", ["name", "level"]), [])
+
+    def test_bad_query(self):
+        with self.assertRaises(ValueError):
+            bf.catalog_query('SELECT "Name" FROM Job', ["name", "level"])
+        with self.assertRaises(ValueError):
+            bf.catalog_query("SELECT count(*) FROM Job", ["count"])
+
+    def test_query_failed(self):
+        #An SQL error must not look like an empty result
+        with mock.patch.object(bf, "bconsole_command", return_value=QUERY_FAILED_OUTPUT):
+            with self.assertRaises(bf.BConsoleError):
+                bf.catalog_query("SELECT 1", ["name", "level"])
+            with self.assertRaises(bf.BConsoleError):
+                bf.get_last_good_jobs()
+            with self.assertRaises(bf.BConsoleError):
+                bf.get_job_files_sample(1204, 1048576, 30)
+
+    def test_last_good_jobs(self):
+        with mock.patch.object(bf, "bconsole_command", return_value=LAST_JOBS_OUTPUT):
+            last_jobs = bf.get_last_good_jobs()
+        self.assertEqual(last_jobs["zbkp_seblab_job"]["F"]["jobbytes"], 4398046511104)
+        self.assertEqual(last_jobs["zbkp_seblab_job"]["D"]["endtime"], datetime(2026, 9, 29, 1, 2, 55))
+        self.assertEqual(last_jobs["zbkp_other_job"]["F"]["jobid"], 1250)
+
+    def test_job_history(self):
+        with mock.patch.object(bf, "bconsole_command", return_value=HISTORY_OUTPUT):
+            history = bf.get_job_history()
+        self.assertEqual(history["zbkp_seblab_job"]["F"]["avgbytes"], 4300000000000)
+        self.assertAlmostEqual(history["zbkp_seblab_job"]["F"]["slope"], 0.00012 * 86400)
+
+class DirectorStatusTest(unittest.TestCase):
+    '''
+    parse_api_output & get_director_status
+    '''
+    def setUp(self):
+        bf.clear_status_cache()
+
+    def tearDown(self):
+        bf.clear_status_cache()
+
+    def test_parse_api_output(self):
+        records = bf.parse_api_output(STATUS_OUTPUT)
+        restore = [record for record in records if record.get("jobid") == "1311"][0]
+        self.assertEqual(restore["name"], "Restore Files")
+        self.assertEqual(restore["job"], "Restore Files.2026-10-19_09.12.40_05")
+        self.assertEqual(restore["status"], "M")
+
+    def test_classify(self):
+        with mock.patch.object(bf, "bconsole_command", return_value=STATUS_OUTPUT):
+            status = bf.get_director_status()
+        #Waiting to mount a tape has started, waiting on the start time hasn't
+        self.assertEqual([job.job_id for job in status.running], [1310, 1311])
+        self.assertEqual([job.job_id for job in status.queued], [1313])
+        self.assertIsNone(status.queued[0].start_time)
+        self.assertEqual(status.running[1].name, "Restore Files")
+        #1312 is in both lists, only the terminated record is kept
+        self.assertEqual([job.job_id for job in status.terminated], [1312, 1290])
+        self.assertEqual(status.terminated[0].status, "T")
+        self.assertEqual(status.terminated[0].job_bytes, 21474836480)
+
+    def test_cache(self):
+        with mock.patch.object(bf, "bconsole_command", return_value=STATUS_OUTPUT) as bconsole:
+            first = bf.get_director_status()
+            self.assertIs(bf.get_director_status(), first)
+            self.assertEqual(bconsole.call_count, 1)
+            refreshed = bf.get_director_status(refresh=True)
+            self.assertIsNot(refreshed, first)
+            self.assertEqual(bconsole.call_count, 2)
+
+    def test_restart_refuses_while_queued(self):
+        only_queued = STATUS_OUTPUT.replace("status=R", "status=T").replace("status=M", "status=T")
+        with mock.patch.object(bf, "bconsole_command", return_value=only_queued), \
+                mock.patch.object(bf.subprocess, "run") as run:
+            self.assertFalse(bf.bacula_restart())
+            run.assert_not_called()
+
+class OrphanedResourcesTest(unittest.TestCase):
+    '''
+    find_orphaned_resources, archive_resources & restore_resources on a generated config tree
+    '''
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.conf_path = self.temp_dir.name + "/"
+        self.write("Client/srv1-fd.cfg", 'Client {\n  Name = "srv1-fd"\n  Address = "srv1"\n}\n')
+        self.write("Client/srv2-fd.cfg", 'Client {\n  Name = "srv2-fd"\n  Address = srv2\n}\n')
+        #Dataset gone from srv1
+        self.add_set("gone", "srv1", "/mnt/data/gone")
+        #Dataset still on srv1
+        self.add_set("live", "srv1", "/mnt/data/live")
+        #srv2 wasn't in the ZFS list (e.g. unreachable), so its Jobs can't be judged
+        self.add_set("other", "srv2", "/mnt/data/other")
+        #Client file missing
+        self.add_set("lost", "srv3", "/mnt/data/lost")
+        #Leftovers with no Job: one unused, one Pool still used by a JobDefs, one by a Schedule override
+        self.write("Fileset/zbkp_old_fs.cfg", 'Fileset {\n  Name = "zbkp_old_fs"\n}\n')
+        self.write("Pool/old_full_pool.cfg", 'Pool {\n  Name = "old_pool_full"\n}\n')
+        self.write("Pool/shared_full_pool.cfg", 'Pool {\n  Name = "shared_pool_full"\n}\n')
+        self.write("JobDefs/Shared_JD.cfg", 'JobDefs {\n  Name = "Shared_JD"\n  Pool = shared_pool_full\n}\n')
+        self.write("Pool/monthly_full_pool.cfg", 'Pool {\n  Name = "monthly_pool_full"\n}\n')
+        #The gone Job's Diff Pool is also used by a Schedule
+        self.write("Schedule/First.cfg", 'Schedule {\n  Name = "First"\n'
+                   '  Run = Level=Full Pool=monthly_pool_full 1st sun at 01:00\n'
+                   '  Run = Level=Differential Pool=gone_pool_diff sun at 01:00\n}\n')
+        self.live_datasets = {("srv1", "/mnt/data/live")}
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, file:str, text:str):
+        os.makedirs(os.path.dirname(self.conf_path + file), exist_ok=True)
+        with open(self.conf_path + file, 'w', encoding='utf-8') as conf_file:
+            conf_file.write(text)
+
+    def add_set(self, set_name:str, server:str, path:str):
+        self.write(f"Job/zbkp_{set_name}_job.cfg",
+                   f'Job {{\n  Name = zbkp_{set_name}_job\n  Client = "{server}-fd"\n'
+                   f'  DifferentialBackupPool = "{set_name}_pool_diff"\n  Fileset = "zbkp_{set_name}_fs"\n'
+                   f'  FullBackupPool = "{set_name}_pool_full"\n  Pool = "{set_name}_pool_full"\n}}\n')
+        self.write(f"Fileset/zbkp_{set_name}_fs.cfg",
+                   f'Fileset {{\n  Name = "zbkp_{set_name}_fs"\n  Include {{\n    File = {path}\n  }}\n}}\n')
+        for level in ("full", "diff"):
+            self.write(f"Pool/{set_name}_{level}_pool.cfg",
+                       f'Pool {{\n  Name = "{set_name}_pool_{level}"\n  ScratchPool = "Scratch"\n}}\n')
+
+    def test_find(self):
+        orphans, unresolved = bf.find_orphaned_resources(self.conf_path, self.live_datasets)
+        self.assertEqual(unresolved, ["zbkp_lost_job"])
+        self.assertEqual(sorted(orphans), ["old", "zbkp_gone_job"])
+        #The Schedule still uses the Diff Pool, so it stays
+        self.assertEqual(sorted(orphans["zbkp_gone_job"]),
+                         sorted(self.conf_path + file for file in ["Job/zbkp_gone_job.cfg",
+                                "Fileset/zbkp_gone_fs.cfg", "Pool/gone_full_pool.cfg"]))
+        self.assertEqual(sorted(orphans["old"]),
+                         sorted(self.conf_path + file for file in ["Fileset/zbkp_old_fs.cfg",
+                                                                   "Pool/old_full_pool.cfg"]))
+
+    def test_archive_and_restore(self):
+        orphans, _unresolved = bf.find_orphaned_resources(self.conf_path, self.live_datasets)
+        files = [file for name in sorted(orphans) for file in orphans[name]]
+        with tempfile.TemporaryDirectory() as archive_path:
+            moved = bf.archive_resources(files, self.conf_path, archive_path)
+            self.assertEqual(len(moved), len(files))
+            for original, archived in moved:
+                self.assertFalse(os.path.exists(original))
+                self.assertTrue(archived.startswith(archive_path))
+                self.assertTrue(os.path.exists(archived))
+            self.assertEqual(bf.find_orphaned_resources(self.conf_path, self.live_datasets)[0], {})
+            bf.restore_resources(moved)
+            for original, _archived in moved:
+                self.assertTrue(os.path.exists(original))
+
+if __name__ == '__main__':
+    unittest.main()